@@ -0,0 +1,45 @@
+""" Scalar vs. array GCJ-02/WGS-84 transforms
+
+Usage:
+    python -m benchmarks.coords [--points 1000000]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from utils import wgs2gcj, gcj2wgs, wgs2gcj_array, gcj2wgs_array, gcj2wgs_exact
+
+
+def timed(fn, *args):
+    t = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=1000000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(30.0, 35.0, args.points)
+    lon = rng.uniform(103.0, 110.0, args.points)
+
+    t_scalar, gcj_scalar = timed(lambda: [wgs2gcj(y, x) for y, x in zip(lat.tolist(), lon.tolist())])
+    t_array, gcj = timed(wgs2gcj_array, lat, lon)
+    assert np.allclose(np.array(gcj_scalar).T, gcj, rtol=0, atol=1e-12)
+    print(f"wgs2gcj       {args.points} points: scalar {t_scalar:.3f}s, array {t_array:.3f}s, {t_scalar / t_array:.0f}x")
+
+    t_scalar, _ = timed(lambda: [gcj2wgs(y, x) for y, x in zip(gcj[0].tolist(), gcj[1].tolist())])
+    t_array, wgs = timed(gcj2wgs_array, *gcj)
+    print(f"gcj2wgs       {args.points} points: scalar {t_scalar:.3f}s, array {t_array:.3f}s, {t_scalar / t_array:.0f}x")
+
+    t_exact, wgs_exact = timed(gcj2wgs_exact, *gcj)
+    err = np.abs(np.concatenate([wgs[0] - lat, wgs[1] - lon])).max()
+    err_exact = np.abs(np.concatenate([wgs_exact[0] - lat, wgs_exact[1] - lon])).max()
+    print(f"gcj2wgs_exact {args.points} points: {t_exact:.3f}s, max error {err_exact:.1e} deg (one-step {err:.1e} deg)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+""" Startup benchmark for Matcher._load_graph
+
+Times the graph ingestion on the bundled graphs and checks that the tables are identical
+to the ones produced by the original quadratic implementation.
+
+Usage:
+    python -m benchmarks.load_graph [--repeat 3]
+"""
+import argparse
+import pickle
+import time
+import warnings
+
+import pandas as pd
+
+from matcher.base import Matcher
+
+warnings.filterwarnings('ignore')
+
+GRAPHS = {
+    'chengdu': 'data/chengdu_graph.pkl',
+    'xian': 'data/xian_graph.pkl',
+}
+
+
+class LegacyMatcher(Matcher):
+    """ Reference implementation of _load_graph before vectorization. """
+    def _load_graph(self, graph, extent):
+        self.G = graph
+
+        node_info = []
+        for node, info in self.G.nodes.items():
+            node_info.append([node, info['y'], info['x'], info['street_count']])
+        node_info = pd.DataFrame(node_info, columns=['osm_id', 'latitude', 'longitude', 'street_count'])
+        node_info['node'] = list(range(len(node_info)))
+        self.node_info = node_info
+
+        self.node_id_map = {}
+        for osm_id, node_id in zip(self.node_info['osm_id'], self.node_info['node']):
+            self.node_id_map[osm_id] = node_id
+
+        edge_info = []
+        existed_edges = []
+        for edge, info in self.G.edges.items():
+            edge_name = '-'.join([str(edge[0]), str(edge[1])])
+            if edge_name not in existed_edges:
+                edge_info.append([edge_name, edge[0], edge[1], info['length'], info.get('highway', 'unclassified')])
+                existed_edges.append(edge_name)
+            edge_name = '-'.join([str(edge[1]), str(edge[0])])
+            if edge_name not in existed_edges:
+                edge_info.append([edge_name, edge[1], edge[0], info['length'], info.get('highway', 'unclassified')])
+                existed_edges.append(edge_name)
+        edge_info = pd.DataFrame(edge_info, columns=['edge_name', 'o', 'd', 'length', 'highway'])
+        edge_info['edge'] = list(range(len(edge_info)))
+        edge_info = pd.merge(edge_info, self.node_info, left_on='o', right_on='osm_id', how='left')
+        edge_info = pd.merge(edge_info, self.node_info, left_on='d', right_on='osm_id', how='left', suffixes=('_o', '_d'))
+        edge_info['longitude'] = (edge_info['longitude_o'] + edge_info['longitude_d']) / 2
+        edge_info['latitude'] = (edge_info['latitude_o'] + edge_info['latitude_d']) / 2
+        self.edge_info = edge_info[['edge', 'edge_name', 'o', 'd', 'length', 'highway', 'longitude', 'latitude',
+                                    'longitude_o', 'latitude_o', 'street_count_o', 'longitude_d', 'latitude_d', 'street_count_d']]
+
+        self.edge_id_map = {}
+        for edge_name, edge_id in zip(self.edge_info['edge_name'], self.edge_info['edge']):
+            self.edge_id_map[edge_name] = edge_id
+
+
+def timed(cls, city, graph, repeat):
+    best, matcher = float('inf'), None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        matcher = cls(city, graph=graph)
+        best = min(best, time.perf_counter() - t)
+    return best, matcher
+
+
+def check_identical(new, old):
+    pd.testing.assert_frame_equal(new.node_info, old.node_info, check_exact=True)
+    pd.testing.assert_frame_equal(new.edge_info, old.edge_info, check_exact=True)
+    assert new.node_id_map == old.node_id_map
+    assert new.edge_id_map == old.edge_id_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'graph':<10}{'nodes':>8}{'edges':>8}{'legacy(s)':>12}{'new(s)':>10}{'speedup':>10}")
+    for city, path in GRAPHS.items():
+        with open(path, 'rb') as fp:
+            g = pickle.load(fp)
+        t_old, old = timed(LegacyMatcher, city, g, args.repeat)
+        t_new, new = timed(Matcher, city, g, args.repeat)
+        check_identical(new, old)
+        print(f"{city:<10}{g.number_of_nodes():>8}{len(new.edge_info):>8}{t_old:>12.4f}{t_new:>10.4f}{t_old / t_new:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
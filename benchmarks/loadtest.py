@@ -0,0 +1,193 @@
+""" Concurrent load test of the matching service (serve.py) with the bundled trajectories
+
+Keeps `--concurrency` keep-alive connections busy until `--requests` requests were answered and reports
+throughput, latency percentiles, status codes and the server's own metrics. Without `--url` it starts
+`serve.py` on a free local port and stops it at the end.
+
+Usage:
+    python -m benchmarks.loadtest --city chengdu --concurrency 8 --requests 200 [--format arrow] [--json out.json]
+    python -m benchmarks.loadtest --url 127.0.0.1:8080 --trajs-per-request 4
+"""
+import argparse
+import asyncio
+import io
+import json
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+from trajectory import read_trajs
+from .pipeline import percentiles
+
+TRAJ_FILES = {'chengdu': 'small_chengdu.csv', 'xian': 'small_xian.csv'}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def load_trajs(city, limit=None):
+    trajs = [traj.copy() for batch in read_trajs([TRAJ_FILES[city]], 'data/', latlon=True, odd_points=True)
+             for traj, _ in batch]
+    return trajs[:limit]
+
+
+def json_body(trajs):
+    return json.dumps({'trajs': [traj.tolist() for traj in trajs]}).encode(), 'application/json'
+
+
+def arrow_body(trajs):
+    import pyarrow as pa
+
+    trip = np.repeat(np.arange(len(trajs)), [len(traj) for traj in trajs])
+    points = np.concatenate(trajs)
+    table = pa.table({'trip': trip, 'lat': points[:, 0], 'lon': points[:, 1], 't': points[:, 2]})
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as stream:
+        stream.write_table(table)
+    return sink.getvalue(), 'application/vnd.apache.arrow.stream'
+
+
+async def request(reader, writer, method, path, body=b'', content_type='application/json'):
+    writer.write((f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: {content_type}\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n').encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+    payload = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, payload
+
+
+async def get_json(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, payload = await request(reader, writer, 'GET', path)
+        return json.loads(payload)
+    finally:
+        writer.close()
+
+
+async def wait_ready(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await get_json(host, port, '/health')
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def run_load(host, port, bodies, n_requests, concurrency):
+    latencies, statuses = [], Counter()
+    sent = 0
+
+    async def client():
+        nonlocal sent
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while sent < n_requests:
+                body, content_type = bodies[sent % len(bodies)]
+                sent += 1
+                t = time.perf_counter()
+                status, _ = await request(reader, writer, 'POST', '/match', body, content_type)
+                latencies.append(time.perf_counter() - t)
+                statuses[status] += 1
+        finally:
+            writer.close()
+
+    t = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - t, latencies, statuses
+
+
+async def main_async(args):
+    host, port = args.url.split(':') if args.url else ('127.0.0.1', free_port())
+    port = int(port)
+    server = None
+    if not args.url:
+        cmd = [sys.executable, 'serve.py', '--city', args.city, '--port', str(port)]
+        if args.workers:
+            cmd += ['--workers', str(args.workers)]
+        server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    try:
+        await wait_ready(host, port, args.startup_timeout)
+        trajs = load_trajs(args.city, args.limit)
+        make_body = arrow_body if args.format == 'arrow' else json_body
+        k = args.trajs_per_request
+        bodies = [make_body(trajs[i:i + k]) for i in range(0, len(trajs) - k + 1, k)]
+
+        if args.warmup:
+            await run_load(host, port, bodies, args.warmup, args.concurrency)
+        elapsed, latencies, statuses = await run_load(host, port, bodies, args.requests, args.concurrency)
+        metrics = await get_json(host, port, '/metrics')
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    ok = statuses.get(200, 0)
+    return {
+        'concurrency': args.concurrency,
+        'format': args.format,
+        'trajs_per_request': k,
+        'requests': len(latencies),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'elapsed_s': elapsed,
+        'requests_per_s': len(latencies) / elapsed,
+        'trajs_per_s': ok * k / elapsed,
+        'latency': percentiles(latencies),
+        'server': metrics,
+    }
+
+
+def print_report(report):
+    lat = report['latency']
+    print(f"{report['requests']} requests ({report['trajs_per_request']} trajs, {report['format']}) "
+          f"at concurrency {report['concurrency']} in {report['elapsed_s']:.1f} s, statuses {report['statuses']}")
+    print(f"throughput  {report['requests_per_s']:.2f} requests/s  {report['trajs_per_s']:.2f} trajs/s")
+    print(f"latency     p50 {lat['p50_ms']:.0f} ms  p90 {lat['p90_ms']:.0f} ms  p99 {lat['p99_ms']:.0f} ms  "
+          f"max {lat['max_ms']:.0f} ms")
+    hists = report['server']['service']['histograms']
+    for name in ('time.queue', 'time.batch', 'batch_size'):
+        if name in hists and hists[name]['count']:
+            h = hists[name]
+            print(f"server {name:<11} mean {h['mean']:.3f}  p50 {h['p50']:.3f}  p99 {h['p99']:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=None, help="host:port of a running service, starts serve.py if omitted")
+    parser.add_argument('--city', choices=sorted(TRAJ_FILES), default='chengdu')
+    parser.add_argument('--workers', type=int, default=None, help="workers of the started service")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=0, help="requests sent before measuring")
+    parser.add_argument('--trajs-per-request', dest='trajs_per_request', type=int, default=1)
+    parser.add_argument('--limit', type=int, default=None, help="number of distinct trajectories")
+    parser.add_argument('--format', choices=['json', 'arrow'], default='json')
+    parser.add_argument('--startup-timeout', dest='startup_timeout', type=float, default=120.0)
+    parser.add_argument('--json', default=None, help="write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
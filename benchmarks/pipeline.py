@@ -0,0 +1,193 @@
+""" Stage-by-stage benchmark of the matching pipeline on the bundled data
+
+Stages: graph load (Matcher construction / _load_graph), init_matcher, parsing (traj_iter),
+HMM matching (_only_nodes_match), projection (rest of _projected_match) and export (TripSink).
+Reports throughput, per-trajectory latency percentiles and peak RSS, and optionally writes JSON
+so runs can be compared across commits.
+
+Usage:
+    python -m benchmarks.pipeline [--city chengdu xian] [--limit 50] [--json out.json]
+    python -m benchmarks.pipeline --profile cprofile --profile-out pipeline.prof
+    python -m benchmarks.pipeline --profile pyinstrument
+
+A sampling profiler can also be attached from outside, e.g. `py-spy record -- python -m benchmarks.pipeline`.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from matcher.leuven_mapmatcher import LeuvenMatcher
+from utils import traj_iter
+from export import TripSink
+
+warnings.filterwarnings('ignore')
+logging.getLogger("be.kuleuven.cs.dtai.mapmatching").setLevel(logging.ERROR)
+
+CITIES = {
+    'chengdu': ('data/chengdu_graph.pkl', 'small_chengdu.csv'),
+    'xian': ('data/xian_graph.pkl', 'small_xian.csv'),
+}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    p = np.percentile(np.asarray(values) * 1000, [50, 90, 99])
+    return {'p50_ms': p[0], 'p90_ms': p[1], 'p99_ms': p[2], 'max_ms': max(values) * 1000}
+
+
+def bench_city(city, limit, export_fmt):
+    graph_path, traj_file = CITIES[city]
+    stages = dict.fromkeys(['graph_load', 'init_matcher', 'parse', 'hmm', 'projection', 'export'], 0.0)
+
+    with open(graph_path, 'rb') as fp:
+        g = pickle.load(fp)
+    t = time.perf_counter()
+    matcher = LeuvenMatcher(city, graph=g)
+    stages['graph_load'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    matcher.init_matcher()
+    stages['init_matcher'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    trajs = [(trip, driver_id) for trip, driver_id in traj_iter('data/', [traj_file], latlon=True)][:limit]
+    stages['parse'] = time.perf_counter() - t
+
+    hmm = matcher._only_nodes_match
+
+    def timed_hmm(traj, stats=None):
+        t_hmm = time.perf_counter()
+        nodes = hmm(traj, stats)
+        stages['hmm'] += time.perf_counter() - t_hmm
+        return nodes
+
+    matcher._only_nodes_match = timed_hmm
+
+    latencies, results = [], []
+    n_points = 0
+    t_match = time.perf_counter()
+    for i, (traj, driver_id) in enumerate(trajs):
+        t = time.perf_counter()
+        res = matcher.match_traj(traj, segment_projected=True)
+        latencies.append(time.perf_counter() - t)
+        n_points += len(traj)
+        if res is not None:
+            results.append((i, res, driver_id))
+    t_match = time.perf_counter() - t_match
+    stages['projection'] = t_match - stages['hmm']
+    del matcher._only_nodes_match
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench' if export_fmt == 'parquet' else 'bench.h5')
+        t = time.perf_counter()
+        with TripSink(path, fmt=export_fmt, road_info=matcher.edge_info, min_itemsize={'driver': 32}) as sink:
+            for i, res, driver_id in results:
+                res = res.reset_index().rename(columns={'index': 'seq_i'})
+                res['trip'] = i
+                sink.add(res, [i, res['timestamp'].min(), res['timestamp'].max(),
+                               res.loc[~res['road'].duplicated(), 'length'].sum() / 1000, driver_id])
+        stages['export'] = time.perf_counter() - t
+
+    return {
+        'city': city,
+        'trajectories': len(trajs),
+        'matched': len(results),
+        'points': n_points,
+        'stages_s': stages,
+        'points_per_s': n_points / t_match,
+        'trajs_per_s': len(trajs) / t_match,
+        'latency': percentiles(latencies),
+        'transition_cache': matcher.transition_cache.stats(),
+    }
+
+
+def print_report(report):
+    for r in report['results']:
+        print(f"== {r['city']}: {r['matched']}/{r['trajectories']} trajectories matched, {r['points']} points")
+        for stage, seconds in r['stages_s'].items():
+            print(f"   {stage:<14}{seconds:>10.4f} s")
+        lat = r['latency']
+        print(f"   throughput    {r['points_per_s']:>10.1f} points/s {r['trajs_per_s']:>8.2f} trajs/s")
+        print(f"   latency       p50 {lat['p50_ms']:.1f} ms  p90 {lat['p90_ms']:.1f} ms  "
+              f"p99 {lat['p99_ms']:.1f} ms  max {lat['max_ms']:.1f} ms")
+        cache = r['transition_cache']
+        print(f"   transitions   hit rate {cache['hit_rate']:.1%}, {cache['entries'] + cache['table_entries']} pairs, "
+              f"{cache['nbytes'] / 1024:.0f} KiB")
+    print(f"peak RSS {report['peak_rss_mb']:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--city', nargs='+', choices=sorted(CITIES), default=sorted(CITIES))
+    parser.add_argument('--limit', type=int, default=None, help="number of trajectories per city")
+    parser.add_argument('--export', choices=['parquet', 'hdf'], default='parquet')
+    parser.add_argument('--json', default=None, help="write the report to this file")
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], default=None)
+    parser.add_argument('--profile-out', default=None, help="cProfile stats file (.prof) or pyinstrument html")
+    args = parser.parse_args()
+
+    profiler = None
+    if args.profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif args.profile == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+
+    results = [bench_city(city, args.limit, args.export) for city in args.city]
+
+    if args.profile == 'cprofile':
+        import pstats
+        profiler.disable()
+        if args.profile_out:
+            profiler.dump_stats(args.profile_out)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    elif args.profile == 'pyinstrument':
+        profiler.stop()
+        if args.profile_out:
+            with open(args.profile_out, 'w') as fp:
+                fp.write(profiler.output_html())
+        print(profiler.output_text(unicode=True, color=False))
+
+    report = {
+        'commit': git_commit(),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'profile': args.profile,
+        'results': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
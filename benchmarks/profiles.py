@@ -0,0 +1,109 @@
+""" Cost and yield of matcher profile cascades on the bundled data
+
+Matches every trajectory once per profile set and reports how many are matched (yield), what the matching
+costs per trajectory (time, lattice states) and how many trajectories fell back to every profile. The sets
+are the single `LeuvenMatcher.matcher_params` configuration, the city's cascade from `run_matching.CITIES`
+(or `LeuvenMatcher.matcher_profiles`) and optionally the {name: profiles} sets of a JSON file.
+
+Usage:
+    python -m benchmarks.profiles [--city chengdu xian] [--limit 50] [--json out.json]
+    python -m benchmarks.profiles --profiles candidates.json
+"""
+import argparse
+import json
+import logging
+import time
+import warnings
+
+from matcher.leuven_mapmatcher import LeuvenMatcher
+from matcher.metrics import MatchMetrics
+from run_matching import CITIES
+from trajectory import read_trajs
+from .pipeline import git_commit, percentiles
+
+warnings.filterwarnings('ignore')
+logging.getLogger("be.kuleuven.cs.dtai.mapmatching").setLevel(logging.ERROR)
+
+TRAJ_FILES = {'chengdu': 'small_chengdu.csv', 'xian': 'small_xian.csv'}
+
+
+def profile_sets(city, extra=None):
+    cascade = CITIES[city].get('profiles') or LeuvenMatcher.matcher_profiles
+    sets = {'single': {'default': {}}, 'cascade': cascade}
+    sets.update(extra or {})
+    return sets
+
+
+def bench_profiles(matcher, trajs, profiles):
+    matcher.use_profiles(profiles)
+    metrics = matcher.instrument(MatchMetrics())
+    latencies = []
+    t_match = time.perf_counter()
+    for traj in trajs:
+        t = time.perf_counter()
+        matcher.match_traj(traj, segment_projected=True, compact=True)
+        latencies.append(time.perf_counter() - t)
+    t_match = time.perf_counter() - t_match
+
+    counters = metrics.counters
+    n = len(trajs)
+    return {
+        'profiles': profiles,
+        'trajectories': n,
+        'matched': counters['matched'],
+        'yield': counters['matched'] / n,
+        'seconds': t_match,
+        'ms_per_traj': t_match / n * 1000,
+        'hmm_ms_per_traj': metrics.histogram('time.hmm').total / n * 1000,
+        'states_per_traj': counters['states'] / n,
+        'fallbacks': counters['fallbacks'],
+        'by_profile': {name: counters[f'profile.{name}'] for name in profiles},
+        'dropped': {key.split('.', 1)[1]: count for key, count in counters.items() if key.startswith('dropped.')},
+        'latency': percentiles(latencies),
+    }
+
+
+def bench_city(city, limit, extra=None):
+    preset = CITIES[city]
+    matcher = LeuvenMatcher(city, graph=preset['graph'], extent=preset['extent'])
+    matcher.init_matcher()
+    trajs = [traj.copy() for batch in read_trajs([TRAJ_FILES[city]], 'data/', latlon=True, odd_points=True)
+             for traj, _ in batch][:limit]
+    return {'city': city, 'sets': {name: bench_profiles(matcher, trajs, profiles)
+                                   for name, profiles in profile_sets(city, extra).items()}}
+
+
+def print_report(report):
+    for r in report['results']:
+        print(f"== {r['city']}")
+        base = r['sets']['single']
+        for name, s in r['sets'].items():
+            lat = s['latency']
+            print(f"   {name:<10} yield {s['matched']:>4}/{s['trajectories']} ({s['yield']:.1%})  "
+                  f"{s['ms_per_traj']:>7.1f} ms/traj ({s['ms_per_traj'] / base['ms_per_traj']:.2f}x)  "
+                  f"hmm {s['hmm_ms_per_traj']:.1f} ms  {s['states_per_traj']:.0f} states/traj  "
+                  f"p99 {lat['p99_ms']:.0f} ms")
+            print(f"   {'':<10} fallbacks {s['fallbacks']}  by profile {s['by_profile']}  dropped {s['dropped']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--city', nargs='+', choices=sorted(TRAJ_FILES), default=sorted(TRAJ_FILES))
+    parser.add_argument('--limit', type=int, default=None, help="number of trajectories per city")
+    parser.add_argument('--profiles', default=None, help="JSON file of more {set name: {profile: overrides}}")
+    parser.add_argument('--json', default=None, help="write the report to this file")
+    args = parser.parse_args()
+
+    extra = None
+    if args.profiles:
+        with open(args.profiles) as fp:
+            extra = json.load(fp)
+    report = {'commit': git_commit(), 'results': [bench_city(city, args.limit, extra) for city in args.city]}
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
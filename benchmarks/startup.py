@@ -0,0 +1,53 @@
+""" Cold vs. warm LeuvenMatcher startup with the compiled map cache
+
+Cold: unpickle the graph, build the tables and the InMemMap, write the artifact.
+Warm: load the artifact (memory mapped), the graph is never unpickled.
+
+Usage:
+    python -m benchmarks.startup [--cache-dir /tmp/mapmatching-cache] [--repeat 5]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+import warnings
+
+from matcher.leuven_mapmatcher import LeuvenMatcher
+
+warnings.filterwarnings('ignore')
+
+GRAPHS = {
+    'chengdu': 'data/chengdu_graph.pkl',
+    'xian': 'data/xian_graph.pkl',
+}
+
+
+def startup(city, path, cache_dir):
+    t = time.perf_counter()
+    matcher = LeuvenMatcher(city, graph=path, cache_dir=cache_dir)
+    matcher.init_matcher()
+    return time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cache-dir', default=None, help="defaults to a fresh temporary directory")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix='mapmatching-cache-')
+    try:
+        print(f"{'graph':<10}{'no cache(s)':>13}{'cold(s)':>10}{'warm(s)':>10}")
+        for city, path in GRAPHS.items():
+            t_none = startup(city, path, None)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            t_cold = startup(city, path, cache_dir)
+            t_warm = min(startup(city, path, cache_dir) for _ in range(args.repeat))
+            print(f"{city:<10}{t_none:>13.4f}{t_cold:>10.4f}{t_warm:>10.4f}")
+    finally:
+        if args.cache_dir is None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
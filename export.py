@@ -0,0 +1,143 @@
+import os
+import time
+
+import pandas as pd
+
+from matcher.result import MatchedBatch, MatchedTrip
+
+
+class TripSink:
+    def __init__(self, path, fmt='parquet', road_info=None, info_columns=('trip', 'start', 'end', 'length', 'driver'),
+                 row_group_size=100000, flush_interval=60, min_itemsize=None, prefix='part'):
+        """ Append-only writer for matched trips
+
+        Matched trips and their trip_info rows are buffered and written out in bounded row groups,
+        so memory stays flat however many trips go through the sink. A crash loses at most the
+        buffered rows.
+
+        Layouts:
+            parquet: a dataset directory `path/` with `road_info.parquet` and one file per flush
+                under `trips/` and `trip_info/` ({prefix}-00000.parquet, ...), each file written atomically.
+            hdf: a single appendable HDF5 file `path` with `trips` and `trip_info` tables and a
+                `road_info` frame.
+
+        Args:
+        --------
+            path: dataset directory (parquet) or .h5 file (hdf)
+            fmt: 'parquet' or 'hdf'
+            road_info: edge table, written once per dataset (skipped if the dataset already has one)
+            info_columns: columns of the trip_info rows given to `add`
+            row_group_size: flush once this many trip rows are buffered
+            flush_interval: flush once this many seconds passed since the last flush, checked on `add`
+            min_itemsize: hdf only, string column widths, e.g. {'driver': 32}
+            prefix: parquet only, part file prefix, so several writers can share a dataset
+        """
+        if fmt not in ('parquet', 'hdf'):
+            raise ValueError(f"Unknown format {fmt}, expected 'parquet' or 'hdf'.")
+        self.path = path
+        self.fmt = fmt
+        self.info_columns = list(info_columns)
+        self.row_group_size = row_group_size
+        self.flush_interval = flush_interval
+        self.min_itemsize = min_itemsize
+        self.prefix = prefix
+
+        self._trips = []
+        self._infos = []
+        self._rows = 0
+        self._last_flush = time.monotonic()
+        self.n_trips = 0
+        self.n_flushes = 0
+
+        if fmt == 'parquet':
+            import pyarrow  # noqa: F401, fail early if the optional dependency is missing
+            os.makedirs(os.path.join(path, 'trips'), exist_ok=True)
+            os.makedirs(os.path.join(path, 'trip_info'), exist_ok=True)
+            self._seq = self._next_seq()
+            self._store = None
+            if road_info is not None and not os.path.exists(os.path.join(path, 'road_info.parquet')):
+                self._write_parquet(_parquet_safe(road_info), os.path.join(path, 'road_info.parquet'))
+        else:
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._store = pd.HDFStore(path, mode='a')
+            if road_info is not None and '/road_info' not in self._store.keys():
+                self._store.put('road_info', road_info, format='fixed')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, trip, info):
+        """ Buffer one matched trip and its trip_info row (sequence in `info_columns` order).
+
+        The trip is a DataFrame or a MatchedTrip, not both kinds in one sink. A MatchedTrip is written with
+        `seq_i` (row in the trip) and `trip` (the first info field) columns added.
+        """
+        self._trips.append(trip)
+        self._infos.append(info)
+        self._rows += len(trip)
+        self.n_trips += 1
+        if self._rows >= self.row_group_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._trips:
+            return
+        if isinstance(self._trips[0], MatchedTrip):
+            trips = MatchedBatch(self._trips, [info[0] for info in self._infos]).to_frame()
+        else:
+            trips = pd.concat(self._trips, ignore_index=True)
+        trip_info = pd.DataFrame(self._infos, columns=self.info_columns)
+        self._trips, self._infos, self._rows = [], [], 0
+
+        if self.fmt == 'parquet':
+            name = f'{self.prefix}-{self._seq:05d}.parquet'
+            self._write_parquet(trips, os.path.join(self.path, 'trips', name))
+            self._write_parquet(trip_info, os.path.join(self.path, 'trip_info', name))
+            self._seq += 1
+        else:
+            self._store.append('trips', trips, format='table', index=False)
+            self._store.append('trip_info', trip_info, format='table', index=False, min_itemsize=self.min_itemsize)
+            self._store.flush(fsync=True)
+        self.n_flushes += 1
+
+    @property
+    def seq(self):
+        """ Sequence number of the next parquet part file, None for hdf. """
+        return self._seq if self.fmt == 'parquet' else None
+
+    def close(self):
+        self.flush()
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _next_seq(self):
+        return max(self.part_seqs(self.path, self.prefix), default=-1) + 1
+
+    @staticmethod
+    def part_seqs(path, prefix='part'):
+        """ Sequence numbers of the `prefix` part files of a parquet dataset. """
+        head = prefix + '-'
+        parts = [f for f in os.listdir(os.path.join(path, 'trips')) if f.startswith(head) and f.endswith('.parquet')]
+        return sorted(int(f[len(head):-len('.parquet')]) for f in parts)
+
+    @staticmethod
+    def _write_parquet(df, filename):
+        tmp = filename + '.tmp'
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, filename)
+
+
+def _parquet_safe(df):
+    """ Object columns mixing scalars and lists (e.g. osm `highway`) are stored as their str(). """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object and df[col].map(lambda v: isinstance(v, (list, tuple))).any():
+            df[col] = df[col].astype(str)
+    return df
@@ -0,0 +1,39 @@
+import numpy as np
+
+R = 6371000.0  # mean earth radius in meters, the same as utils.haversine
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great circle distance in meters between arrays of points (decimal degrees), array version of utils.haversine
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=float)) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+
+def project_to_segment(lon, lat, lon_o, lat_o, lon_d, lat_d):
+    """
+    Perpendicular projection of points onto segments o -> d, all arguments are arrays of the same length.
+
+    Coordinates are projected to a local equirectangular plane around each segment, which is accurate
+    at road segment scale.
+
+    Returns:
+    --------
+        t: position of the projection along the segment in [0, 1], 0 for degenerate segments
+        proj_lon, proj_lat: the projected points
+        dist: distance in meters between the points and their projection
+    """
+    lon, lat, lon_o, lat_o, lon_d, lat_d = (np.asarray(v, dtype=float) for v in (lon, lat, lon_o, lat_o, lon_d, lat_d))
+    kx = np.cos(np.radians((lat_o + lat_d) / 2))
+    sx, sy = (lon_d - lon_o) * kx, lat_d - lat_o
+    px, py = (lon - lon_o) * kx, lat - lat_o
+    seg2 = sx * sx + sy * sy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(seg2 > 0, (px * sx + py * sy) / seg2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    proj_lon = lon_o + t * (lon_d - lon_o)
+    proj_lat = lat_o + t * (lat_d - lat_o)
+    dist = np.radians(np.hypot(px - t * sx, py - t * sy)) * R
+    return t, proj_lon, proj_lat, dist
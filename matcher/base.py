@@ -1,40 +1,98 @@
 import os
 import datetime
 import abc
+import pickle
 
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
+import numpy as np
 import pandas as pd
 import osmnx as ox
 
-from utils import gcj2wgs
+from utils import gcj2wgs_array, wgs2gcj_array
+from . import batch, render
+from .cache import CompiledMap, cache_key, file_fingerprint, graph_fingerprint
+from .metrics import MatchMetrics
 
 
 class Matcher:
-    def __init__(self, name, graph=None, bgimg=None, extent=[]):
+    def __init__(self, name, graph=None, bgimg=None, extent=[], cache_dir=None):
         """ Base Matcher
 
         Args:
         --------
             name: a str object
-            graph: a network Graph object, download with extent from osm if None
+            graph: a network Graph object or the path of a pickled one, download with extent from osm if None
             bgimg: background image path
             extent: [min_lon, max_lon, min_lat, max_lat]
+            cache_dir: directory of compiled map artifacts, disabled if None. With a warm cache and a graph
+                path, the graph itself is only unpickled when something accesses `self.G`.
         """
         super().__init__()
 
         self.name = f"{name}-mapmatcher"
+        self.compiled = self._open_cache(graph, cache_dir)
         self._load_graph(graph, extent)
         self.bgimg = bgimg
         self.extent = extent
+        self._traj_bounds = None
+        self._basemaps = {}
 
         self.matcher = None
 
+        self.metrics = None
+        self.callbacks = []
+        self.last_stats = None
+
     def __call__(self, *args, **kwds):
         return self.match_traj(*args, **kwds)
-    
+
+    @property
+    def G(self):
+        if self._G is None and self.graph_path is not None:
+            with open(self.graph_path, 'rb') as fp:
+                self._G = pickle.load(fp)
+        return self._G
+
+    @G.setter
+    def G(self, graph):
+        self._G = graph
+
+    @property
+    def traj_bounds(self):
+        """ [min_lon, max_lon, min_lat, max_lat] of the map in trajectory (GCJ-02) coordinates.
+
+        Taken from `self.extent` (WGS-84) if given, else from the graph nodes.
+        """
+        if self._traj_bounds is None:
+            if len(self.extent) == 4:
+                lon, lat = np.asarray(self.extent[:2], dtype=float), np.asarray(self.extent[2:], dtype=float)
+            else:
+                lon = self.node_info['longitude'].agg(['min', 'max']).to_numpy(dtype=float)
+                lat = self.node_info['latitude'].agg(['min', 'max']).to_numpy(dtype=float)
+            lat, lon = wgs2gcj_array(lat, lon)
+            self._traj_bounds = [lon[0], lon[1], lat[0], lat[1]]
+        return self._traj_bounds
+
+    def compile_params(self):
+        """ Parameters that change the compiled map artifact, part of the cache key. """
+        return {'matcher': type(self).__name__}
+
+    def _open_cache(self, graph, cache_dir):
+        if cache_dir is None or graph is None:
+            return None
+        if isinstance(graph, (str, os.PathLike)):
+            fingerprint = file_fingerprint(graph)
+        else:
+            fingerprint = graph_fingerprint(graph)
+        return CompiledMap(cache_dir, self.name, cache_key(fingerprint, self.compile_params()))
+
     def _load_graph(self, graph, extent):
-        if graph is not None:
+        self._G = None
+        self.graph_path = None
+        if isinstance(graph, (str, os.PathLike)):
+            self.graph_path = graph
+        elif graph is not None:
             self.G = graph
 
         if graph is None and extent:
@@ -45,56 +103,129 @@ class Matcher:
         if graph is None and len(extent) != 4:
             raise ValueError("Please input a valid graph or a valid extent.")
 
-        node_info = []
-        for node, info in self.G.nodes.items():
-            # street_count: Count how many physical street segments connect to each node in a graph.
-            node_info.append([node, info['y'], info['x'], info['street_count']])
-        node_info = pd.DataFrame(node_info, columns=['osm_id', 'latitude', 'longitude', 'street_count'])
-        node_info['node'] = list(range(len(node_info)))
-        self.node_info = node_info
+        if self.compiled is not None and self.compiled.exists():
+            self.node_info, self.edge_info = self.compiled.load_tables()
+        else:
+            self.node_info = self._build_node_info(self.G)
+            self.edge_info = self._build_edge_info(self.G, self.node_info)
 
         self.node_id_map = {}
         for osm_id, node_id in zip(self.node_info['osm_id'], self.node_info['node']):
             self.node_id_map[osm_id] = node_id
 
-        edge_info = []
-        existed_edges = []
-        for edge, info in self.G.edges.items():
-            edge_name = '-'.join([str(edge[0]), str(edge[1])])
-            if edge_name not in existed_edges:
-                edge_info.append([
-                    edge_name,
-                    edge[0],
-                    edge[1],
-                    info['length'],
-                    info.get('highway', 'unclassified')
-                ])
-                existed_edges.append(edge_name)
-            
-            edge_name = '-'.join([str(edge[1]), str(edge[0])])
-            # if not info['oneway'] and edge_name not in existed_edges:
-            if edge_name not in existed_edges:  # regard as undirected graph
-                edge_info.append([
-                    edge_name,
-                    edge[1],
-                    edge[0],
-                    info['length'],
-                    info.get('highway', 'unclassified')
-                ])
-                existed_edges.append(edge_name)
-        edge_info = pd.DataFrame(edge_info, columns=['edge_name', 'o', 'd', 'length', 'highway'])
-        edge_info['edge'] = list(range(len(edge_info)))
-        edge_info = pd.merge(edge_info, self.node_info, left_on='o', right_on='osm_id', how='left')
-        edge_info = pd.merge(edge_info, self.node_info, left_on='d', right_on='osm_id', how='left', suffixes=('_o', '_d'))
-        edge_info['longitude'] = (edge_info['longitude_o'] + edge_info['longitude_d']) / 2
-        edge_info['latitude'] = (edge_info['latitude_o'] + edge_info['latitude_d']) / 2
-        self.edge_info = edge_info[['edge', 'edge_name', 'o', 'd', 'length', 'highway', 'longitude', 'latitude', 
-                                    'longitude_o', 'latitude_o', 'street_count_o', 'longitude_d', 'latitude_d', 'street_count_d']]
-
         self.edge_id_map = {}
         for edge_name, edge_id in zip(self.edge_info['edge_name'], self.edge_info['edge']):
             self.edge_id_map[edge_name] = edge_id
 
+        self._build_edge_lookup()
+
+    def _build_edge_lookup(self):
+        """ Integer-indexed edge lookup for per-trajectory enrichment without merges or string keys.
+
+        edge_pair_map: (o, d) osm ids -> edge id, edge ids are positions in `self.edge_info`
+        edge_arrays: contiguous per-edge columns, gathered with `edge_arrays[col][edge_ids]`
+        """
+        self.edge_pair_map = dict(zip(zip(self.edge_info['o'].tolist(), self.edge_info['d'].tolist()),
+                                      self.edge_info['edge'].tolist()))
+        self.edge_arrays = {col: np.ascontiguousarray(self.edge_info[col].to_numpy(dtype=float))
+                            for col in ['length', 'longitude', 'latitude', 'longitude_o', 'latitude_o',
+                                        'longitude_d', 'latitude_d']}
+
+    @staticmethod
+    def _build_node_info(G):
+        """ Columnar node table, one row per graph node in iteration order. """
+        n = G.number_of_nodes()
+        node_info = pd.DataFrame({
+            'osm_id': list(G.nodes),
+            'latitude': np.fromiter((info['y'] for info in G.nodes.values()), dtype=float, count=n),
+            'longitude': np.fromiter((info['x'] for info in G.nodes.values()), dtype=float, count=n),
+            # street_count: Count how many physical street segments connect to each node in a graph.
+            'street_count': [info['street_count'] for info in G.nodes.values()],
+        })
+        node_info['node'] = np.arange(n, dtype=np.int64)
+        return node_info
+
+    @staticmethod
+    def _build_edge_info(G, node_info):
+        """ Columnar edge table in linear time.
+
+        Every graph edge (u, v) contributes the candidates (u, v) and (v, u), in that order, and
+        only the first occurrence of each directed pair is kept (the graph is regarded as undirected).
+        """
+        n = G.number_of_edges()
+        us, vs = np.empty(n, dtype=object), np.empty(n, dtype=object)
+        lengths = np.empty(n, dtype=float)
+        highways = np.empty(n, dtype=object)
+        for i, (edge, info) in enumerate(G.edges.items()):
+            us[i], vs[i] = edge[0], edge[1]
+            lengths[i] = info['length']
+            highways[i] = info.get('highway', 'unclassified')
+
+        # interleave forward and backward candidates: u0-v0, v0-u0, u1-v1, v1-u1, ...
+        o = np.empty(2 * n, dtype=object)
+        d = np.empty(2 * n, dtype=object)
+        o[0::2], o[1::2] = us, vs
+        d[0::2], d[1::2] = vs, us
+        o = pd.Series(o).infer_objects()
+        d = pd.Series(d).infer_objects()
+        keep = ~pd.DataFrame({'o': o, 'd': d}).duplicated(keep='first').to_numpy()
+
+        o = o[keep].reset_index(drop=True)
+        d = d[keep].reset_index(drop=True)
+        edge_info = pd.DataFrame({
+            'edge': np.arange(len(o), dtype=np.int64),
+            'edge_name': o.astype(str) + '-' + d.astype(str),
+            'o': o,
+            'd': d,
+            'length': np.repeat(lengths, 2)[keep],
+            'highway': np.repeat(highways, 2)[keep],
+        })
+
+        nodes = pd.Index(node_info['osm_id'])
+        o_idx = nodes.get_indexer(o)
+        d_idx = nodes.get_indexer(d)
+        lat = node_info['latitude'].to_numpy()
+        lon = node_info['longitude'].to_numpy()
+        street_count = node_info['street_count'].to_numpy()
+        edge_info['longitude_o'] = lon[o_idx]
+        edge_info['latitude_o'] = lat[o_idx]
+        edge_info['street_count_o'] = street_count[o_idx]
+        edge_info['longitude_d'] = lon[d_idx]
+        edge_info['latitude_d'] = lat[d_idx]
+        edge_info['street_count_d'] = street_count[d_idx]
+        edge_info['longitude'] = (edge_info['longitude_o'] + edge_info['longitude_d']) / 2
+        edge_info['latitude'] = (edge_info['latitude_o'] + edge_info['latitude_d']) / 2
+        return edge_info[['edge', 'edge_name', 'o', 'd', 'length', 'highway', 'longitude', 'latitude',
+                          'longitude_o', 'latitude_o', 'street_count_o', 'longitude_d', 'latitude_d', 'street_count_d']]
+
+    def instrument(self, metrics=None, callbacks=()):
+        """ Turn on per-trajectory instrumentation.
+
+        Every `match_traj` call then produces a stats dict (also kept as `self.last_stats`):
+            points, hmm_points, stages ({stage: seconds}), lattice_width, states, breaks, fallbacks, profile,
+            drop_reason
+        which is recorded into `metrics` and passed to every callback.
+
+        Args:
+        --------
+            metrics: a MatchMetrics, a new one if None
+            callbacks: callables taking the stats dict
+        """
+        self.metrics = metrics if metrics is not None else MatchMetrics()
+        self.callbacks = list(callbacks)
+        return self.metrics
+
+    @property
+    def instrumented(self):
+        return self.metrics is not None or len(self.callbacks) > 0
+
+    def _emit(self, stats):
+        self.last_stats = stats
+        if self.metrics is not None:
+            self.metrics.record(stats)
+        for callback in self.callbacks:
+            callback(stats)
+
     @abc.abstractmethod
     def init_matcher(self):
         pass
@@ -107,6 +238,13 @@ class Matcher:
             self.visualize(traj, matched_path, time_tag=time_tag)
         pass
 
+    def match_many(self, trajs, workers=None, chunksize=16, **kwargs):
+        """ Match many trajectories over a process pool, see `matcher.batch.match_many`.
+
+        Yields BatchResult(index, result, error) in input order.
+        """
+        return batch.match_many(self, trajs, workers=workers, chunksize=chunksize, **kwargs)
+
     def visualize(self, traj, matched_path, time_tag=False):
         fig = plt.figure(figsize=(10, 10))
 
@@ -121,16 +259,10 @@ class Matcher:
             
         else:
             ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
-            nodes_lon, nodes_lat = [], []
-            for node in self.G.nodes:
-                lat, lon = self.G.nodes[node]['y'], self.G.nodes[node]['x']
-                nodes_lat.append(lat)
-                nodes_lon.append(lon)
-            ax.plot(nodes_lon, nodes_lat, 'b.')
+            ax.plot(self.node_info['longitude'], self.node_info['latitude'], 'b.')
         
-        traj = [e[:2] for e in traj]
-        wgs_trajs = [gcj2wgs(lat, lon) for lat, lon in traj]
-        traj_lat, traj_lon = zip(*wgs_trajs)
+        traj = np.asarray([e[:2] for e in traj], dtype=float)
+        traj_lat, traj_lon = gcj2wgs_array(traj[:, 0], traj[:, 1])
         # ax.plot(traj_lon, traj_lat, 'r')
         ax.plot(traj_lon, traj_lat, 'r.')
 
@@ -149,3 +281,18 @@ class Matcher:
             pic_name = self.name
             
         fig.savefig('images/{}.png'.format(pic_name))
+
+    def basemap(self, width=800, dpi=100):
+        """ Background of the rendered trips, prepared on first use, see `matcher.render.Basemap`. """
+        if (width, dpi) not in self._basemaps:
+            self._basemaps[(width, dpi)] = render.Basemap.from_matcher(self, width=width, dpi=dpi)
+        return self._basemaps[(width, dpi)]
+
+    def render_many(self, items, out_dir, workers=None, width=800, **kwargs):
+        """ Render (name, traj, result) items to `out_dir/name.png` over one basemap, see `matcher.render.render_many`. """
+        return render.render_many(self.basemap(width), items, out_dir, workers=workers, **kwargs)
+
+    def render_heatmap(self, results, filename, width=800):
+        """ Render how many of the matched results traverse every edge. """
+        renderer = render.TripRenderer(self.basemap(width))
+        renderer.render_heatmap(render.road_counts(results, len(self.edge_info)), filename)
@@ -0,0 +1,160 @@
+import gc
+import os
+import multiprocessing as mp
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .metrics import MatchMetrics
+
+
+# index: position in the input, result: match_traj output (None on failure), error: None or the drop reason,
+# stats: the per-trajectory stats when the matcher is instrumented
+BatchResult = namedtuple('BatchResult', ['index', 'result', 'error', 'stats'], defaults=[None])
+
+_matcher = None
+_match_kwargs = {}
+
+
+@contextmanager
+def frozen_heap():
+    # objects alive at fork time are left out of the workers' garbage collections, which would otherwise
+    # write to every one of them and turn the inherited map pages into private copies
+    gc.collect()
+    gc.freeze()
+    try:
+        yield
+    finally:
+        gc.unfreeze()
+
+
+def _init_worker(matcher, match_kwargs, in_process=False):
+    # with the fork start method the arguments are inherited, not pickled, so every worker
+    # shares the parent's initialized map pages copy-on-write
+    # matcher: a Matcher, or {key: Matcher} for the keyed items of match_keyed
+    global _matcher, _match_kwargs
+    _matcher = matcher
+    _match_kwargs = match_kwargs
+    if not in_process:
+        for m in matcher.values() if isinstance(matcher, dict) else [matcher]:
+            if m.instrumented:
+                # child-local sinks: the stats travel back with the results and the parent records them
+                m.metrics = MatchMetrics()
+                m.callbacks = []
+
+
+def match_item(matcher, i, traj, match_kwargs):
+    matcher.last_stats = None
+    try:
+        result = matcher.match_traj(traj, **match_kwargs)
+    except Exception as e:
+        return BatchResult(i, None, f'{type(e).__name__}: {e}', matcher.last_stats)
+    stats = matcher.last_stats
+    if result is None:
+        return BatchResult(i, None, 'unmatched', stats)
+    return BatchResult(i, result, None, stats)
+
+
+def _match_one(item):
+    if len(item) == 3:
+        i, key, traj = item
+        if key is None:
+            return None, BatchResult(i, None, 'out_of_bounds')
+        return key, match_item(_matcher[key], i, traj, _match_kwargs)
+    return match_item(_matcher, item[0], item[1], _match_kwargs)
+
+
+def _imap(matcher, items, workers, chunksize, match_kwargs):
+    # _match_one over the items, in-process or with a pool forked from the frozen heap
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers <= 1:
+        _init_worker(matcher, match_kwargs, in_process=True)
+        for item in items:
+            yield _match_one(item)
+        return
+
+    methods = mp.get_all_start_methods()
+    ctx = mp.get_context('fork' if 'fork' in methods else None)
+    with frozen_heap(), ctx.Pool(workers, initializer=_init_worker, initargs=(matcher, match_kwargs)) as pool:
+        yield from pool.imap(_match_one, items, chunksize=chunksize)
+
+
+def _match_window(window):
+    # a stats dict per window, merged by the caller
+    stats = {'stages': {}, 'breaks': 0, 'fallbacks': 0, 'drop_reason': None} if _matcher.instrumented else None
+    _, trip = _matcher._projected_match(window, stats)
+    return trip, stats
+
+
+def window_pool(matcher, workers):
+    """ A pool of worker processes for `match_windows`, to reuse across trajectories.
+
+    The workers are forked with the matcher as it is now, later changes to it (params, profiles,
+    instrumentation) do not reach them. The caller closes the pool.
+    """
+    methods = mp.get_all_start_methods()
+    ctx = mp.get_context('fork' if 'fork' in methods else None)
+    return ctx.Pool(workers, initializer=_init_worker, initargs=(matcher, {}))
+
+
+def match_windows(matcher, windows, workers, pool=None):
+    """ Run `_projected_match` over the windows of one trajectory with a pool of worker processes.
+
+    Without a `window_pool` a pool is started for the trajectory, which only pays off for very long
+    trajectories. Cannot be used from inside `match_many` workers, which are daemonic and cannot start a pool.
+
+    Returns:
+    --------
+        A list of (trip or None, stats or None) in window order.
+    """
+    if pool is not None:
+        return pool.map(_match_window, windows, chunksize=1)
+    with window_pool(matcher, min(workers, len(windows))) as pool:
+        return pool.map(_match_window, windows, chunksize=1)
+
+
+def match_many(matcher, trajs, workers=None, chunksize=16, **match_kwargs):
+    """ Match an iterable of trajectories with a pool of worker processes.
+
+    Args:
+    --------
+        matcher: an initialized Matcher
+        trajs: iterable of trajectories in the `match_traj` format, consumed lazily
+        workers: number of processes, os.cpu_count() if None, in-process if <= 1
+        chunksize: trajectories sent to a worker at a time
+        match_kwargs: forwarded to `match_traj`
+
+    Yields:
+    --------
+        BatchResult in input order, as soon as the chunk holding it is done.
+        A failed trajectory yields result=None and the reason in `error`, the batch goes on.
+    """
+    if matcher.matcher is None:
+        raise ValueError("matcher not initialized")
+    in_pool = (workers or os.cpu_count()) > 1
+    for res in _imap(matcher, enumerate(trajs), workers, chunksize, match_kwargs):
+        if in_pool and res.stats is not None:
+            matcher._emit(res.stats)
+        yield res
+
+
+def match_keyed(matchers, items, workers=None, chunksize=16, **match_kwargs):
+    """ `match_many` over several matchers with one pool, every trajectory naming its matcher.
+
+    Args:
+    --------
+        matchers: {key: initialized Matcher}
+        items: iterable of (key, trajectory), key None for a trajectory no matcher takes, consumed lazily
+        workers, chunksize, match_kwargs: as in `match_many`
+
+    Yields:
+    --------
+        (key, BatchResult) in input order, error 'out_of_bounds' for the key None.
+    """
+    in_pool = (workers or os.cpu_count()) > 1
+    items = ((i, key, traj) for i, (key, traj) in enumerate(items))
+    for key, res in _imap(matchers, items, workers, chunksize, match_kwargs):
+        if in_pool and res.stats is not None:
+            matchers[key]._emit(res.stats)
+        yield key, res
@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+CACHE_VERSION = 1
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """ Content hash of a (pickled) graph file. """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def graph_fingerprint(G):
+    """ Content hash of an in-memory graph: node ids, coordinates, edge endpoints and attributes
+    used to build the map tables.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr([(node, info['y'], info['x'], info['street_count']) for node, info in G.nodes.items()]).encode())
+    h.update(repr([(edge[0], edge[1], info['length'], info.get('highway', 'unclassified'))
+                   for edge, info in G.edges.items()]).encode())
+    return h.hexdigest()
+
+
+def cache_key(fingerprint, params):
+    payload = json.dumps({'version': CACHE_VERSION, 'graph': fingerprint, 'params': params},
+                         sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+
+def _save_frame(df, path, prefix):
+    """ Numeric columns go to one .npy file each so they can be memory mapped, everything else is pickled. """
+    columns, objects = [], {}
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if values.dtype.kind in 'biuf':
+            np.save(os.path.join(path, f'{prefix}.{col}.npy'), values)
+        else:
+            objects[col] = df[col]
+        columns.append(col)
+    with open(os.path.join(path, f'{prefix}.pkl'), 'wb') as fp:
+        pickle.dump({'columns': columns, 'objects': objects}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_array(filename, mmap_mode):
+    # plain ndarray view over the mapping, so np.memmap does not leak into derived frames
+    return np.load(filename, mmap_mode=mmap_mode).view(np.ndarray)
+
+
+def _load_frame(path, prefix, mmap_mode):
+    with open(os.path.join(path, f'{prefix}.pkl'), 'rb') as fp:
+        meta = pickle.load(fp)
+    data = {}
+    for col in meta['columns']:
+        if col in meta['objects']:
+            data[col] = meta['objects'][col]
+        else:
+            data[col] = _load_array(os.path.join(path, f'{prefix}.{col}.npy'), mmap_mode)
+    return pd.DataFrame(data, columns=meta['columns'], copy=False)
+
+
+class CompiledMap:
+    def __init__(self, cache_dir, name, key):
+        """ On-disk compiled map artifact
+
+        A directory holding everything a matcher needs at startup:
+            - node/edge tables (node_info, edge_info), numeric columns as .npy
+            - GCJ-02 node coordinates (gcj.npy, [lat, lon] rows in node_info order)
+            - adjacency in CSR layout over node_info rows (indptr.npy, indices.npy)
+            - the serialized state of the matcher's map object (map_state.pkl)
+
+        Numeric arrays are loaded with memory mapping, so workers reading the same artifact
+        share the page cache instead of holding private copies.
+
+        Args:
+        --------
+            cache_dir: root directory of the cache
+            name: matcher name, only used to make the directory readable
+            key: cache key from `cache_key`
+        """
+        self.key = key
+        self.path = os.path.join(cache_dir, f'{name}-{key[:16]}')
+
+    def exists(self):
+        meta_file = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file) as fp:
+            meta = json.load(fp)
+        return meta.get('version') == CACHE_VERSION and meta.get('key') == self.key
+
+    def save(self, node_info, edge_info, arrays, map_state):
+        """ Write the artifact atomically: build it in a sibling temp dir and rename it into place. """
+        root = os.path.dirname(self.path)
+        os.makedirs(root, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=root)
+        try:
+            _save_frame(node_info, tmp, 'node_info')
+            _save_frame(edge_info, tmp, 'edge_info')
+            for name, values in arrays.items():
+                np.save(os.path.join(tmp, f'{name}.npy'), values)
+            with open(os.path.join(tmp, 'map_state.pkl'), 'wb') as fp:
+                pickle.dump(map_state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as fp:
+                json.dump({'version': CACHE_VERSION, 'key': self.key, 'arrays': sorted(arrays),
+                           'n_nodes': len(node_info), 'n_edges': len(edge_info)}, fp)
+            os.rename(tmp, self.path)
+        except OSError:
+            # another process published the same artifact first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not self.exists():
+                raise
+
+    def load_tables(self, mmap_mode='r'):
+        return _load_frame(self.path, 'node_info', mmap_mode), _load_frame(self.path, 'edge_info', mmap_mode)
+
+    def load_arrays(self, mmap_mode='r'):
+        with open(os.path.join(self.path, 'meta.json')) as fp:
+            names = json.load(fp)['arrays']
+        return {name: _load_array(os.path.join(self.path, f'{name}.npy'), mmap_mode) for name in names}
+
+    def load_map_state(self):
+        with open(os.path.join(self.path, 'map_state.pkl'), 'rb') as fp:
+            return pickle.load(fp)
@@ -1,114 +1,424 @@
-import math
+import time
+
 import numpy as np
 import pandas as pd
-from leuvenmapmatching.matcher.distance import DistanceMatcher
-from leuvenmapmatching.map.inmem import InMemMap
 
 from .base import Matcher
-from utils import wgs2gcj, haversine, cal_angle
+from . import batch
+from .spatial import ArrayMap, IndexedMap, SegmentGrid
+from .shared import CsrEdgeMap, LabelIndex, SharedArrays
+from .routing import RoutedDistanceMatcher, TransitionCache
+from .result import MatchedTrip, route_frame
+from utils import wgs2gcj_array, gcj2wgs_array
+from geometry import project_to_segment
+from preprocess import preprocess as preprocess_traj
 
 
 class LeuvenMatcher(Matcher):
-    def __init__(self, name="leuven_matcher", graph=None, bgimg=None, extent=[]):
+    # use lonlat false
+    # matcher_params = dict(max_dist=50, obs_noise=2, min_prob_norm=0.04, max_lattice_width=5)
+    # use lonlat true
+    # Parameters work in Chengdu, start candidates come from the segment index within max_dist_init
+    matcher_params = dict(max_dist=50000, obs_noise=100, min_prob_norm=0.01, obs_noise_ne=100,
+                          dist_noise=500, max_lattice_width=5, max_dist_init=300)
+    # cheap first: overrides of matcher_params tried in order, a trajectory whose match has no start candidates,
+    # breaks or misses points is matched again with the next profile, see _only_nodes_match
+    matcher_profiles = {'narrow': dict(max_lattice_width=3),
+                        'wide': dict(obs_noise=200, obs_noise_ne=200, dist_noise=1000, max_dist_init=1000)}
+    # used by match_traj(preprocess=True), see preprocess.preprocess
+    preprocess_params = dict(min_dist=10, min_interval=None, max_speed=50, min_points=2)
+    # used by match_traj(windowed=True): points per window, points shared by neighbouring windows
+    # and processes matching the windows of one trajectory
+    window_params = dict(size=200, overlap=30, workers=1)
+    grid_cell_size = 250.0  # meters, cells of the segment index used for start candidates
+    # edge-to-edge route lengths used by the transitions, see routing.TransitionCache,
+    # precompute_radius pins every pair within that many meters at init
+    transition_params = dict(capacity=100000, max_dist=2000.0, precompute_radius=None)
+
+    def __init__(self, name="leuven_matcher", graph=None, bgimg=None, extent=[], cache_dir=None, profiles=None):
+        # profiles: {name: matcher_params overrides} replacing matcher_profiles, e.g. a city's own
         assert graph != None, "You must supply a graph."
-        super().__init__(name, graph, bgimg, extent)
+        super().__init__(name, graph, bgimg, extent, cache_dir)
+        if profiles is not None:
+            self.matcher_profiles = profiles
+        self.matchers = {}
+        # batch.window_pool reused by windowed matching instead of a pool per trajectory
+        self.window_pool = None
+
+    def compile_params(self):
+        params = super().compile_params()
+        params.update({'map': 'IndexedMap', 'use_latlon': True, 'crs': 'gcj02', 'matcher_params': self.matcher_params,
+                       'grid_cell_size': self.grid_cell_size})
+        return params
 
     def init_matcher(self):
-        self.map_con = InMemMap(self.name, use_latlon=True)
-        for node in self.G.nodes:
-            self.map_con.add_node(node, wgs2gcj(self.G.nodes[node]['y'], self.G.nodes[node]['x']))  # id, lat, lon
-        for node_s, node_e in self.G.edges():
-            self.map_con.add_edge(node_s, node_e)
-            self.map_con.add_edge(node_e, node_s)
-
-        # use lonlat false
-        # self.matcher = DistanceMatcher(self.map_con, max_dist=50, obs_noise=2, min_prob_norm=0.04, max_lattice_width=5)
-        # use lonlat true
-        self.matcher = DistanceMatcher(self.map_con, max_dist=50000, obs_noise=100, min_prob_norm=0.01, obs_noise_ne=100, 
-                                       dist_noise=500, max_lattice_width=5)  # Parameters work in Chengdu
-
-    def match_traj(self, traj, visualize=False, save_time_tag=False, segment_projected=False):
+        if self.compiled is not None and self.compiled.exists():
+            self.map_con = IndexedMap.deserialize(self.compiled.load_map_state())
+            self.map_con.name = self.name
+            self.map_arrays = self.compiled.load_arrays()
+            grid = self._build_grid(self.map_arrays)
+        else:
+            self.map_con = self._build_map()
+            self.map_arrays = self._build_map_arrays()
+            grid = self._build_grid()
+            self.map_arrays.update(grid.to_arrays())
+            if self.compiled is not None:
+                self.compiled.save(self.node_info, self.edge_info, self.map_arrays, self.map_con.serialize())
+        self.map_con.set_index(grid, self.node_info['osm_id'].tolist())
+
+        # one cache per matcher, so it is shared by all trips matched in a process
+        self.transition_cache = TransitionCache(self.map_arrays, self.node_info['osm_id'].tolist(),
+                                                capacity=self.transition_params['capacity'],
+                                                max_dist=self.transition_params['max_dist'])
+        if self.transition_params['precompute_radius'] is not None:
+            self.transition_cache.precompute(self.transition_params['precompute_radius'])
+        self.use_profiles(self.matcher_profiles)
+
+    def use_profiles(self, profiles):
+        """ Match with other matcher profiles ({name: matcher_params overrides}, tried in order) without
+        rebuilding the map. Every profile gets a matcher sharing the map and the transition cache,
+        self.matcher is the one used last.
+        """
+        assert len(profiles) > 0, "At least one matcher profile is needed"
+        self.matcher_profiles = profiles
+        self.matchers = {name: RoutedDistanceMatcher(self.map_con, transition_cache=self.transition_cache,
+                                                     **dict(self.matcher_params, **overrides))
+                         for name, overrides in profiles.items()}
+        self.matcher = next(iter(self.matchers.values()))
+
+    def share_arrays(self):
+        """ Move the map arrays into one shared memory block and serve the map from them.
+
+        The map (`ArrayMap`), the transition cache lookups and `edge_pair_map` then read the shared CSR
+        arrays instead of per-node dicts, so worker processes add no private copy of the map. Matching
+        results are unchanged. The caller owns the returned SharedArrays and unlinks it when done.
+        """
+        if self.matcher is None:
+            raise ValueError("matcher not initialized")
+        index = LabelIndex(self.node_info['osm_id'].to_numpy(dtype=np.int64))
+        indptr, indices = self.map_arrays['indptr'], self.map_arrays['indices']
+        src = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        labels = index.labels.tolist()
+        csr_edge = np.fromiter((self.edge_pair_map[(labels[a], labels[b])] for a, b in zip(src.tolist(), indices.tolist())),
+                               dtype=np.int64, count=len(indices))
+        arrays = dict(self.map_arrays, lengths=self.transition_cache.lengths, csr_edge=csr_edge, **index.to_arrays())
+        arrays.update({f'edge.{col}': values for col, values in self.edge_arrays.items()})
+        shared = SharedArrays(arrays)
+
+        self.map_arrays = {name: shared[name] for name in self.map_arrays}
+        self.edge_arrays = {col: shared[f'edge.{col}'] for col in self.edge_arrays}
+        index = LabelIndex(shared['labels'], shared['label_order'], shared['labels_sorted'])
+        self.map_con = ArrayMap(self.name, index, shared['gcj'], shared['indptr'], shared['indices'],
+                                self._build_grid(self.map_arrays))
+        for matcher in self.matchers.values():
+            matcher.map = self.map_con
+        self.transition_cache.use_index(index, shared['lengths'])
+        self.edge_pair_map = CsrEdgeMap(index, shared['indptr'], shared['indices'], shared['csr_edge'])
+        return shared
+
+    def _build_map(self):
+        map_con = IndexedMap(self.name, use_latlon=True)
+        gcj_lat, gcj_lon = wgs2gcj_array(self.node_info['latitude'], self.node_info['longitude'])
+        for node, lat, lon in zip(self.node_info['osm_id'].tolist(), gcj_lat.tolist(), gcj_lon.tolist()):
+            map_con.add_node(node, (lat, lon))  # id, lat, lon
+        # edge_info holds both directions of every graph edge in first-seen order
+        for node_s, node_e in zip(self.edge_info['o'].tolist(), self.edge_info['d'].tolist()):
+            map_con.add_edge(node_s, node_e)
+        return map_con
+
+    def _build_map_arrays(self):
+        """ GCJ-02 node coordinates and CSR adjacency of `self.map_con`, rows follow `self.node_info`. """
+        graph = self.map_con.graph
+        osm_ids = self.node_info['osm_id'].tolist()
+        gcj = np.array([graph[osm_id][0] for osm_id in osm_ids], dtype=float).reshape(-1, 2)
+        degree = np.fromiter((len(graph[osm_id][1]) for osm_id in osm_ids), dtype=np.int64, count=len(osm_ids))
+        indptr = np.zeros(len(osm_ids) + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        indices = np.fromiter((self.node_id_map[nbr] for osm_id in osm_ids for nbr in graph[osm_id][1]),
+                              dtype=np.int64, count=indptr[-1])
+        return {'gcj': gcj, 'indptr': indptr, 'indices': indices}
+
+    def _build_grid(self, arrays=None):
+        """ Segment index over the directed edges of the CSR adjacency, `arrays` holds a cached one. """
+        indptr = self.map_arrays['indptr']
+        src = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        gcj = self.map_arrays['gcj']
+        return SegmentGrid(gcj[:, 0], gcj[:, 1], src, self.map_arrays['indices'], cell_size=self.grid_cell_size,
+                           arrays=arrays)
+
+    def match_traj(self, traj, visualize=False, save_time_tag=False, segment_projected=False, preprocess=False,
+                   windowed=False, compact=False, route=False):
         # traj: [(lon_1, lat_1), (lon_2, lat_2), ...] or [(lon_1, lat_1, t1), (lon_2, lat_2, t2), ...]
+        # preprocess: clean the trajectory with self.preprocess_params first, `obs` still indexes traj,
+        #   without segment_projected the result is a list of node routes, one per part
+        # windowed: match overlapping windows of self.window_params and stitch them, needs segment_projected
+        # compact: return a result.MatchedTrip instead of a DataFrame, needs segment_projected
+        # route: return the edge traversals (result.compress_route) instead of the rows, needs segment_projected
         assert len(traj) > 0
+        assert segment_projected or not windowed, "Windowed matching needs segment_projected"
+        assert segment_projected or not (compact or route), "Compact and route results need segment_projected"
 
-        if segment_projected:
-            nodes, matched_routes = self._projected_match(traj)
+        stats = None
+        if self.instrumented:
+            stats = {'points': len(traj), 'stages': {}, 'breaks': 0, 'fallbacks': 0, 'drop_reason': None}
+            t_start = time.perf_counter()
+
+        if preprocess:
+            nodes, matched_routes = self._preprocessed_match(traj, segment_projected, stats, windowed)
+        elif windowed:
+            nodes, matched_routes = self._windowed_match(traj, stats)
+        elif segment_projected:
+            nodes, matched_routes = self._projected_match(traj, stats, compact=compact or route)
         else:
-            nodes = self._only_nodes_match(traj)
+            nodes = self._only_nodes_match(traj, stats)
             matched_routes = [(node, self.G.nodes[node]['x'], self.G.nodes[node]['y']) for node in nodes]
 
+        if route and matched_routes is not None:
+            matched_routes = route_frame(matched_routes)
+        elif compact and isinstance(matched_routes, pd.DataFrame):
+            matched_routes = MatchedTrip.from_frame(matched_routes)
+
         if visualize:
             self.visualize(traj, nodes, time_tag=save_time_tag)
 
+        if stats is not None:
+            stats['stages']['total'] = time.perf_counter() - t_start
+            self._emit(stats)
         return matched_routes
         
-    def _projected_match(self, traj):
+    def _preprocessed_match(self, traj, segment_projected, stats=None, windowed=False):
+        """ Match the parts left by `preprocess.preprocess` and join them.
+
+        Parts are matched independently; in the projected frame `obs` is mapped back to the rows of traj
+        and `part` numbers the parts. Parts that fail to match are left out. The parts are not connected,
+        so without segment_projected every part keeps its own list of (node, x, y).
+        """
+        if stats is not None:
+            t_start = time.perf_counter()
+        traj = np.asarray(traj, dtype=float)
+        params = dict(self.preprocess_params)
+        if traj.shape[1] < 3:
+            # untimed (lat, lon) rows, only the spatial steps apply
+            params.update(min_interval=None, max_speed=None)
+        parts = preprocess_traj(traj, bounds=self.traj_bounds, **params)
+        if stats is not None:
+            stats['stages']['preprocess'] = time.perf_counter() - t_start
+            stats['hmm_points'] = sum(len(index) for index in parts)
+
+        nodes, matched_routes = [], []
+        for part, index in enumerate(parts):
+            if not segment_projected:
+                part_nodes = self._only_nodes_match(traj[index], stats)
+                if part_nodes:
+                    matched_routes.append([(node, self.G.nodes[node]['x'], self.G.nodes[node]['y'])
+                                           for node in part_nodes])
+                nodes.extend(part_nodes)
+                continue
+            match = self._windowed_match if windowed else self._projected_match
+            part_nodes, trip = match(traj[index], stats)
+            nodes.extend(part_nodes)
+            if trip is not None:
+                trip['obs'] = index[trip['obs'].to_numpy()]
+                trip['part'] = part
+                matched_routes.append(trip)
+
+        if segment_projected:
+            if not matched_routes:
+                if stats is not None and not parts:
+                    stats['drop_reason'] = 'out_of_bounds'
+                return nodes, None
+            if stats is not None:
+                stats['drop_reason'] = None
+            matched_routes = pd.concat(matched_routes, ignore_index=True)
+        return nodes, matched_routes
+
+    def _windowed_match(self, traj, stats=None):
+        """ `_projected_match` over overlapping windows, stitched into one trip.
+
+        Only one window's lattice is alive at a time, so memory is bounded by the window size. A window
+        that fails to match only leaves a gap in `obs`. Neighbouring windows are cut inside their overlap
+        at the observation nearest to its middle where both matched the same road, or at the middle.
+        """
+        size, overlap, workers = self.window_params['size'], self.window_params['overlap'], self.window_params['workers']
+        assert 0 <= overlap < size, "Window overlap must be smaller than the window size"
+        if len(traj) <= size:
+            return self._projected_match(traj, stats)
+
+        starts = range(0, len(traj) - overlap, size - overlap)
+        bounds = [(start, min(start + size, len(traj))) for start in starts]
+        windows = [traj[start:end] for start, end in bounds]
+        if workers > 1 or self.window_pool is not None:
+            results = batch.match_windows(self, windows, workers, pool=self.window_pool)
+            if stats is not None:
+                for _, window_stats in results:
+                    self._merge_stats(stats, window_stats)
+        else:
+            results = [(self._projected_match(window, stats)[1], None) for window in windows]
+
+        matched = []
+        for (start, end), (trip, _) in zip(bounds, results):
+            if trip is not None:
+                trip['obs'] += start
+                matched.append((start, end, trip))
+        if stats is not None:
+            stats['windows'] = len(windows)
+            stats['dropped_windows'] = len(windows) - len(matched)
+            if matched:
+                stats['drop_reason'] = None
+        if not matched:
+            return [], None
+
+        trip = self._stitch_windows(matched)
+        o, d = self.edge_info['o'].to_numpy(), self.edge_info['d'].to_numpy()
+        roads = trip['road'].to_numpy()
+        roads = roads[np.concatenate(([True], roads[1:] != roads[:-1]))]
+        nodes = [int(o[roads[0]])] + d[roads].tolist()
+        return nodes, trip
+
+    @staticmethod
+    def _stitch_windows(matched):
+        # matched: [(start, end, trip with global obs), ...] in order
+        cuts = []
+        for (_, prev_end, prev), (start, _, trip) in zip(matched[:-1], matched[1:]):
+            if prev_end <= start:  # a dropped window in between
+                cuts.append(start)
+                continue
+            middle = (start + prev_end) // 2
+            prev_roads = prev.loc[prev['obs_ne'] == 0].set_index('obs')['road']
+            roads = trip.loc[trip['obs_ne'] == 0].set_index('obs')['road']
+            obs = np.arange(start, prev_end)
+            agree = obs[prev_roads.reindex(obs).to_numpy() == roads.reindex(obs).to_numpy()]
+            cuts.append(agree[np.argmin(np.abs(agree - middle))] if len(agree) else middle)
+
+        lower = [-1] + cuts
+        upper = cuts + [np.inf]
+        trips = [trip[(trip['obs'] >= lo) & (trip['obs'] < hi)] for (_, _, trip), lo, hi in zip(matched, lower, upper)]
+        return pd.concat(trips, ignore_index=True)
+
+    def _record_profile(self, stats, profile):
+        # the furthest profile needed by any part or window of the trajectory
+        names = list(self.matchers)
+        if stats.get('profile') is None or names.index(stats['profile']) < names.index(profile):
+            stats['profile'] = profile
+
+    def _merge_stats(self, stats, window_stats):
+        stats['stages']['hmm'] = stats['stages'].get('hmm', 0.0) + window_stats['stages'].get('hmm', 0.0)
+        stats['stages']['projection'] = stats['stages'].get('projection', 0.0) + window_stats['stages'].get('projection', 0.0)
+        stats['lattice_width'] = max(stats.get('lattice_width', 0), window_stats.get('lattice_width', 0))
+        stats['states'] = stats.get('states', 0) + window_stats.get('states', 0)
+        stats['candidates'] = stats.get('candidates', 0) + window_stats.get('candidates', 0)
+        stats['breaks'] += window_stats['breaks']
+        stats['fallbacks'] += window_stats['fallbacks']
+        if window_stats.get('profile') is not None:
+            self._record_profile(stats, window_stats['profile'])
+
+    def _projected_match(self, traj, stats=None, compact=False):
         assert len(traj[0]) == 3, "Only 3D trajectory is supported when segment_projected is True"
 
         timestamps = [e[2] for e in traj]
-        nodes = self._only_nodes_match(traj)
+        nodes = self._only_nodes_match(traj, stats)
+        if stats is not None:
+            t_start = time.perf_counter()
 
-        trip = []
-        for state in self.matcher.lattice_best:
-            trip.append(['-'.join([str(state.edge_m.l1), str(state.edge_m.l2)]), state.obs, state.obs_ne])  # state.edge_m.l2 is int type
-        trip = pd.DataFrame(trip, columns=['road', 'obs', 'obs_ne'])
+        states = self.matcher.lattice_best
+        n = len(states)
+        edge = np.fromiter((self.edge_pair_map[(state.edge_m.l1, state.edge_m.l2)] for state in states), dtype=np.int64, count=n)
+        obs = np.fromiter((state.obs for state in states), dtype=np.int64, count=n)
+        obs_ne = np.fromiter((state.obs_ne for state in states), dtype=np.int64, count=n)
+        emitting = obs_ne == 0
 
-        if not len(trip[trip['obs_ne'] == 0]) == len(timestamps):
+        if not emitting.sum() == len(timestamps):
             # lengths of traj and matched traj do not match
             # raise ValueError("A unknown error occurs.")
+            if stats is not None:
+                stats['drop_reason'] = self._drop_reason()
             return nodes, None
-        trip.loc[trip['obs_ne'] == 0, 'timestamp'] = timestamps
-        trip['timestamp'] = trip['timestamp'].interpolate()  # inter- and extra- polate timestamp
-
-        trip.loc[trip['obs_ne'] == 0, 'longitude'] = [e[1] for e in traj]
-        trip.loc[trip['obs_ne'] == 0, 'latitude'] = [e[0] for e in traj]
-        trip_ne = pd.merge(trip.loc[trip['obs_ne'] != 0, ['road', 'obs', 'obs_ne']], self.edge_info, left_on='road', right_on='edge_name', how='left')
-        trip.loc[trip['obs_ne'] != 0, ['longitude', 'latitude']] = trip_ne[['longitude', 'latitude']].values
-
-        # road prop is NOT CORRECT
-        # TODO: CORRECT THE ROAD PROP CALCULATING
-        trip = pd.merge(trip, self.edge_info[['edge_name', 'edge', 'length', 'longitude_o', 'latitude_o', 'longitude_d', 'latitude_d']], left_on='road', right_on='edge_name', how='left')
-        road_prop = [haversine(lon_o, lat_o, lon, lat) * abs(math.cos(math.radians(cal_angle(lat_o, lon_o, lat, lon) - cal_angle(lat_o, lon_o, lat_d, lon_d)))) / haversine(lon_o, lat_o, lon_d, lat_d)
-                     for lon, lat, lon_o, lat_o, lon_d, lat_d in zip(trip['longitude'], trip['latitude'], trip['longitude_o'], trip['latitude_o'], trip['longitude_d'], trip['latitude_d'])]
-        # road_prop = [haversine(lon1, lat1, lon2, lat2) / l 
-                            #  for lon1, lat1, lon2, lat2, l in zip(trip['longitude'], trip['latitude'], trip['longitude_o'], trip['latitude_o'], trip['length'])]
-        trip['road_prop'] = np.clip(road_prop, 0, 1)
-        trip['timestamp'] = pd.to_datetime(trip['timestamp'], unit='s')
-        trip = trip[['edge', 'obs', 'obs_ne', 'timestamp', 'longitude', 'latitude', 'length', 'road_prop']]
-        trip = trip.rename(columns={"edge": "road"})
+        timestamp = np.full(n, np.nan)
+        timestamp[emitting] = timestamps
+        timestamp = pd.Series(timestamp).interpolate()  # inter- and extra- polate timestamp
 
+        edges = self.edge_arrays
+        longitude, latitude = edges['longitude'][edge], edges['latitude'][edge]
+        longitude[emitting] = [e[1] for e in traj]
+        latitude[emitting] = [e[0] for e in traj]
+
+        # road prop: perpendicular projection onto the matched edge, in WGS-84 like the edge endpoints
+        lon, lat = longitude.copy(), latitude.copy()
+        lat[emitting], lon[emitting] = gcj2wgs_array(latitude[emitting], longitude[emitting])
+        road_prop, _, _, _ = project_to_segment(lon, lat, edges['longitude_o'][edge], edges['latitude_o'][edge],
+                                                edges['longitude_d'][edge], edges['latitude_d'][edge])
+
+        if compact:
+            trip = MatchedTrip(edge, obs, obs_ne, np.round(timestamp.to_numpy() * 1e9), longitude, latitude,
+                               edges['length'][edge], road_prop)
+        else:
+            trip = pd.DataFrame({
+                'road': edge,
+                'obs': obs,
+                'obs_ne': obs_ne,
+                'timestamp': pd.to_datetime(timestamp, unit='s'),
+                'longitude': longitude,
+                'latitude': latitude,
+                'length': edges['length'][edge],
+                'road_prop': road_prop,
+            })
+
+        if stats is not None:
+            stats['stages']['projection'] = stats['stages'].get('projection', 0.0) + time.perf_counter() - t_start
         return nodes, trip
 
-    def _only_nodes_match(self, traj):
+    def _broke(self):
+        # early_stop_idx is only reset once start candidates are found
+        lattice = self.matcher.lattice
+        return bool(lattice) and len(lattice[0].values(0)) > 0 and self.matcher.early_stop_idx is not None
+
+    def _matched_all(self, n_points):
+        states = self.matcher.lattice_best
+        return len(states) > 0 and not self._broke() and sum(state.obs_ne == 0 for state in states) == n_points
+
+    def _drop_reason(self):
+        lattice = self.matcher.lattice
+        if not lattice or len(lattice[0].values(0)) == 0:
+            return 'no_candidates'
+        if self._broke():
+            return 'broken'
+        return 'length_mismatch'
+
+    def _lattice_stats(self):
+        """ Widest emitting column and number of states in the last lattice. """
+        width, states = 0, 0
+        for column in (self.matcher.lattice or {}).values():
+            width = max(width, len(column.values(0)))
+            states += sum(len(layer) for layer in column.o)
+        return width, states
+
+    def _only_nodes_match(self, traj, stats=None):
         assert len(traj[0]) == 2 or len(traj[0]) == 3
 
-        time_obtain = False
-        if len(traj[0]) == 3:
-            time_obtain = True
-        
-        if time_obtain:
-            timestamps = [e[2] for e in traj]
-            traj = [e[:2] for e in traj]
+        # timestamps are dropped, edge timings come from `route=True` in match_traj
+        # plain float pairs, numpy rows are much slower to index and to format in the matcher's debug logging
+        traj = np.asarray(traj, dtype=float)[:, :2].tolist()
 
-        states, _ = self.matcher.match(traj)
+        for fallback, (profile, matcher) in enumerate(self.matchers.items()):
+            if stats is not None:
+                t_start = time.perf_counter()
+            self.matcher = matcher
+            matcher.match(traj)
+            matched = self._matched_all(len(traj))
+            if stats is not None:
+                # accumulated over the profiles tried and the parts of a preprocessed trajectory
+                width, n_states = self._lattice_stats()
+                stats['stages']['hmm'] = stats['stages'].get('hmm', 0.0) + time.perf_counter() - t_start
+                stats['lattice_width'] = max(stats.get('lattice_width', 0), width)
+                stats['states'] = stats.get('states', 0) + n_states
+                stats['candidates'] = stats.get('candidates', 0) + self.map_con.last_candidates
+                stats['breaks'] += int(self._broke())
+            if matched:
+                break
         nodes = self.matcher.path_pred_onlynodes  # traj consisted of nodes
-
-        # with timestamps
-        # if time_obtain:
-        #     if len(self.matcher.lattice_best) == len(timestamps):
-        #         lattice = list((*e.key, int(timestamp)) for e, timestamp in zip(self.matcher.lattice_best, timestamps))  # traj consisted of state transitiions
-        #     else:
-        #         lattice = []
-        #         timestamps = iter(timestamps)
-        #         timestamp = next(timestamps)
-        #         for e in self.matcher.lattice_best:
-        #             e = e.key
-        #             lattice.append((*e, timestamp))
-        #             if int(e[2]):
-        #                 timestamp = next(timestamps)
-        #     return self.get_node_timestamps(lattice)
-        # else:
-        #     return nodes
+        if stats is not None:
+            stats['fallbacks'] += fallback
+            self._record_profile(stats, profile)
 
         return nodes
 
@@ -0,0 +1,111 @@
+import json
+import math
+import time
+from collections import Counter
+
+
+class Histogram:
+    __slots__ = ['buckets', 'count', 'total', 'min', 'max']
+
+    def __init__(self):
+        """ Log2-bucketed histogram, bucket k counts values in [2**k, 2**(k+1)). """
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.buckets[math.floor(math.log2(value)) if value > 0 else None] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile. """
+        if self.count == 0:
+            return None
+        rank, seen = q * self.count, 0
+        for k in sorted(self.buckets, key=lambda k: -math.inf if k is None else k):
+            seen += self.buckets[k]
+            if seen >= rank:
+                return 0.0 if k is None else min(2.0 ** (k + 1), self.max)
+        return self.max
+
+    def snapshot(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count, 'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+class MatchMetrics:
+    def __init__(self, dump_path=None, dump_interval=60):
+        """ Aggregated per-trajectory matching metrics
+
+        Counters: trajectories, matched, dropped, dropped.<reason>, breaks, fallbacks, profile.<name> (trajectories
+            whose furthest matcher profile was name), windows, dropped_windows, points, hmm_points, states, candidates
+        Histograms: time.<stage> (seconds), points, lattice_width, states, candidates (start candidates)
+
+        Args:
+        --------
+            dump_path: if given, a JSON line with the snapshot is appended to this file every dump_interval seconds
+            dump_interval: seconds between periodic dumps
+        """
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.reset()
+
+    def reset(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self._last_dump = time.monotonic()
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def record(self, stats):
+        """ Add the stats of one trajectory, see `Matcher.match_traj`. """
+        self.counters['trajectories'] += 1
+        self.counters['points'] += stats['points']
+        self.counters['hmm_points'] += stats.get('hmm_points', stats['points'])
+        self.counters['breaks'] += stats.get('breaks', 0)
+        self.counters['fallbacks'] += stats.get('fallbacks', 0)
+        if stats.get('profile') is not None:
+            self.counters[f"profile.{stats['profile']}"] += 1
+        self.counters['windows'] += stats.get('windows', 0)
+        self.counters['dropped_windows'] += stats.get('dropped_windows', 0)
+        if stats.get('drop_reason') is None:
+            self.counters['matched'] += 1
+        else:
+            self.counters['dropped'] += 1
+            self.counters[f"dropped.{stats['drop_reason']}"] += 1
+        for stage, seconds in stats['stages'].items():
+            self.histogram(f'time.{stage}').add(seconds)
+        self.histogram('points').add(stats['points'])
+        if 'states' in stats:
+            self.counters['states'] += stats['states']
+            self.histogram('states').add(stats['states'])
+            self.histogram('lattice_width').add(stats['lattice_width'])
+        if 'candidates' in stats:
+            self.counters['candidates'] += stats['candidates']
+            self.histogram('candidates').add(stats['candidates'])
+
+        if self.dump_path is not None and time.monotonic() - self._last_dump >= self.dump_interval:
+            self.dump()
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'counters': dict(self.counters),
+            'histograms': {name: hist.snapshot() for name, hist in sorted(self.histograms.items())},
+        }
+
+    def dump(self, path=None):
+        """ Append a JSON line with the current snapshot. """
+        with open(path or self.dump_path, 'a') as fp:
+            fp.write(json.dumps(self.snapshot()) + '\n')
+        self._last_dump = time.monotonic()
@@ -0,0 +1,127 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class MatchSession:
+    __slots__ = ['vehicle_id', 'points', 'base', 'done', 'last_seen', 'n_points', 'n_dropped']
+
+    def __init__(self, vehicle_id, now):
+        """ Matching state of one vehicle
+
+        `points` holds the received points from global index `base` on, `done` is the global index of
+        the first point whose rows are not emitted yet.
+        """
+        self.vehicle_id = vehicle_id
+        self.points = []
+        self.base = 0
+        self.done = 0
+        self.last_seen = now
+        self.n_points = 0
+        self.n_dropped = 0
+
+
+class OnlineMatcher:
+    def __init__(self, matcher, lag=10, step=5, overlap=10, idle_timeout=300):
+        """ Incremental matching of live GPS feeds, one session per vehicle
+
+        Points are buffered per vehicle. Whenever `step` new points are more than `lag` points behind the
+        newest one, the buffer tail is matched with `overlap` already emitted points as context, and
+        the rows of those points are emitted. So the lag is bounded by lag + step points, the cost per point
+        is bounded by (overlap + step + lag) / step matched points, and a session never holds more than
+        overlap + step + lag points. A window that fails to match drops its points, not the session.
+
+        Args:
+        --------
+            matcher: an initialized LeuvenMatcher, shared by all sessions
+            lag: points held back before their rows are emitted
+            step: new points that trigger a match
+            overlap: emitted points matched again as context
+            idle_timeout: seconds without points after which `expire` closes a session
+        """
+        if matcher.matcher is None:
+            raise ValueError("matcher not initialized")
+        self.matcher = matcher
+        self.lag = lag
+        self.step = step
+        self.overlap = overlap
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()  # least recently seen first
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, vehicle_id, points, now=None):
+        """ Add (lat, lon, t) points of a vehicle, opening its session if needed.
+
+        A large batch of points is buffered up to every point that triggers a match, as if the points
+        arrived one by one, so the session stays within its bound.
+
+        Returns:
+        --------
+            The newly finalized rows in the `match_traj(segment_projected=True)` format, `obs` counting the
+            points received for the vehicle, or None.
+        """
+        now = time.time() if now is None else now
+        session = self.sessions.get(vehicle_id)
+        if session is None:
+            session = self.sessions[vehicle_id] = MatchSession(vehicle_id, now)
+        else:
+            self.sessions.move_to_end(vehicle_id)
+        session.last_seen = now
+        points = [tuple(p) for p in points]
+        emitted = []
+        i = 0
+        while i < len(points):
+            n = max(session.done + self.lag + self.step - session.n_points, 1)
+            session.points.extend(points[i:i + n])
+            session.n_points += len(points[i:i + n])
+            i += n
+            if session.n_points - self.lag - session.done >= self.step:
+                rows = self._advance(session, session.n_points - self.lag)
+                if rows is not None:
+                    emitted.append(rows)
+        if not emitted:
+            return None
+        return emitted[0] if len(emitted) == 1 else pd.concat(emitted, ignore_index=True)
+
+    def close(self, vehicle_id):
+        """ Emit the remaining rows of a vehicle and drop its session. """
+        session = self.sessions.pop(vehicle_id)
+        return self._advance(session, session.n_points)
+
+    def expire(self, now=None):
+        """ Close the sessions idle for more than idle_timeout, returns {vehicle_id: remaining rows or None}. """
+        now = time.time() if now is None else now
+        expired = []
+        for vehicle_id, session in self.sessions.items():
+            if now - session.last_seen <= self.idle_timeout:
+                break
+            expired.append(vehicle_id)
+        return {vehicle_id: self.close(vehicle_id) for vehicle_id in expired}
+
+    def close_all(self):
+        return {vehicle_id: self.close(vehicle_id) for vehicle_id in list(self.sessions)}
+
+    def _advance(self, session, end):
+        # match from `overlap` points before `done` to the newest point, emit the rows of [done, end)
+        if end <= session.done:
+            return None
+        start = max(session.done - self.overlap, session.base)
+        window = np.asarray(session.points[start - session.base:], dtype=float)
+        _, trip = self.matcher._projected_match(window)
+
+        rows = None
+        if trip is None:
+            session.n_dropped += end - session.done
+        else:
+            trip['obs'] += start
+            rows = trip[(trip['obs'] >= session.done) & (trip['obs'] < end)].reset_index(drop=True)
+
+        session.done = end
+        keep = max(end - self.overlap, session.base)
+        del session.points[:keep - session.base]
+        session.base = keep
+        return rows
@@ -0,0 +1,107 @@
+import numpy as np
+
+from . import batch
+
+
+class MatcherRegistry:
+    def __init__(self, matchers=None):
+        """ Several city matchers behind one matching API
+
+        Every trajectory is routed to the city whose bounds (`Matcher.traj_bounds`, from `extent` or the
+        map) hold most of its points. `share` moves the map arrays of every city into shared memory
+        once, so a pool of N workers serving M cities holds M maps instead of N x M.
+
+        Args:
+        --------
+            matchers: {name: initialized LeuvenMatcher}, more can be added with `add`
+        """
+        self.matchers = {}
+        self.shared = {}
+        self._bounds = np.empty((0, 4))
+        for name, matcher in (matchers or {}).items():
+            self.add(name, matcher)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.matchers)
+
+    def __contains__(self, name):
+        return name in self.matchers
+
+    def __getitem__(self, name):
+        return self.matchers[name]
+
+    @property
+    def names(self):
+        return list(self.matchers)
+
+    def add(self, name, matcher):
+        if name in self.matchers:
+            raise ValueError(f"City {name} already registered.")
+        if matcher.matcher is None:
+            matcher.init_matcher()
+        self.matchers[name] = matcher
+        self._bounds = np.array([m.traj_bounds for m in self.matchers.values()], dtype=float)
+
+    def route(self, traj):
+        """ Name of the city holding most points of a (lat, lon, ...) trajectory, the first registered on ties,
+        None if no city holds any.
+        """
+        traj = np.asarray(traj, dtype=float)
+        if not len(self.matchers) or not len(traj):
+            return None
+        lat, lon = traj[:, 0, None], traj[:, 1, None]
+        b = self._bounds
+        inside = ((lon >= b[:, 0]) & (lon <= b[:, 1]) & (lat >= b[:, 2]) & (lat <= b[:, 3])).sum(axis=0)
+        best = int(np.argmax(inside))
+        return self.names[best] if inside[best] > 0 else None
+
+    def match_traj(self, traj, **kwargs):
+        """ Route and match one trajectory, returns (city, `match_traj` result), (None, None) if out of every city. """
+        name = self.route(traj)
+        if name is None:
+            return None, None
+        return name, self.matchers[name].match_traj(traj, **kwargs)
+
+    def share(self):
+        """ Move the map arrays of every city not shared yet into shared memory, see `LeuvenMatcher.share_arrays`.
+
+        Returns:
+        --------
+            Total bytes of the shared blocks.
+        """
+        for name, matcher in self.matchers.items():
+            if name not in self.shared:
+                self.shared[name] = matcher.share_arrays()
+        return sum(shared.nbytes for shared in self.shared.values())
+
+    def close(self):
+        """ Free the shared blocks, the shared matchers must not be used afterwards. """
+        for shared in self.shared.values():
+            shared.close()
+            shared.unlink()
+        self.shared = {}
+
+    def match_many(self, trajs, workers=None, chunksize=16, **match_kwargs):
+        """ Route and match an iterable of trajectories with one pool of worker processes for all cities,
+        see `batch.match_keyed`.
+
+        Args:
+        --------
+            trajs: iterable of trajectories in the `match_traj` format, consumed lazily
+            workers: number of processes, os.cpu_count() if None, in-process if <= 1
+            chunksize: trajectories sent to a worker at a time
+            match_kwargs: forwarded to `match_traj`
+
+        Yields:
+        --------
+            (city, BatchResult) in input order, city None and error 'out_of_bounds' for a trajectory outside
+            every city.
+        """
+        routed = ((self.route(traj), traj) for traj in trajs)
+        return batch.match_keyed(self.matchers, routed, workers=workers, chunksize=chunksize, **match_kwargs)
@@ -0,0 +1,183 @@
+import os
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from PIL import Image
+
+from utils import gcj2wgs_array
+
+
+class Basemap:
+    def __init__(self, extent, segments, image=None, width=800, dpi=100):
+        """ Background prepared once and shared by every rendered trip
+
+        Without an image the road segments are rasterized once into the background array. Figures
+        keep the degrees of the extent roughly square in meters.
+
+        Args:
+        --------
+            extent: [min_lon, max_lon, min_lat, max_lat], WGS-84
+            segments: float array (n_edges, 2, 2) of the edge [(lon_o, lat_o), (lon_d, lat_d)], WGS-84
+            image: background image path, drawn over extent, or None
+            width: image width in pixels
+            dpi: dots per inch of the figures
+        """
+        self.extent = list(extent)
+        self.segments = np.asarray(segments, dtype=float)
+        self.dpi = dpi
+        min_lon, max_lon, min_lat, max_lat = self.extent
+        ratio = (max_lat - min_lat) / ((max_lon - min_lon) * np.cos(np.radians((min_lat + max_lat) / 2)))
+        self.size = (width / dpi, width * ratio / dpi)
+        if image is not None:
+            import matplotlib.pyplot as plt
+            self.array = plt.imread(image)
+        else:
+            fig, ax = self.figure()
+            ax.add_collection(LineCollection(self.segments, colors='0.75', linewidths=0.5))
+            fig.canvas.draw()
+            self.array = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+    @classmethod
+    def from_matcher(cls, matcher, width=800, dpi=100):
+        edges = matcher.edge_arrays
+        segments = np.stack([np.stack([edges['longitude_o'], edges['latitude_o']], axis=1),
+                             np.stack([edges['longitude_d'], edges['latitude_d']], axis=1)], axis=1)
+        image = matcher.bgimg if matcher.bgimg and len(matcher.extent) == 4 else None
+        if len(matcher.extent) == 4:
+            extent = matcher.extent
+        else:
+            lon, lat = segments[..., 0], segments[..., 1]
+            extent = [lon.min(), lon.max(), lat.min(), lat.max()]
+        return cls(extent, segments, image=image, width=width, dpi=dpi)
+
+    def figure(self):
+        """ A bare Agg figure with one axes filling it over the extent, outside of pyplot. """
+        fig = Figure(figsize=self.size, dpi=self.dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_xlim(self.extent[0], self.extent[1])
+        ax.set_ylim(self.extent[2], self.extent[3])
+        return fig, ax
+
+
+def road_path(result):
+    """ Roads of a matched trip (projected DataFrame, MatchedTrip or route frame) with repeats collapsed. """
+    road = result['road'].to_numpy() if isinstance(result, pd.DataFrame) else result.road
+    road = np.asarray(road)
+    if len(road) == 0:
+        return road
+    return road[np.concatenate(([True], road[1:] != road[:-1]))]
+
+
+class TripRenderer:
+    def __init__(self, basemap, compress_level=1):
+        """ Draws trips over a Basemap with one reused figure
+
+        The background is drawn once and restored as pixels for every trip, which only replaces the
+        segments of a line collection and the point offsets and draws these two artists.
+
+        Args:
+        --------
+            basemap: Basemap
+            compress_level: png zlib level, the encoding dominates the rendering time at high levels
+        """
+        self.compress_level = compress_level
+        self.basemap = basemap
+        self.fig, self.ax = basemap.figure()
+        self.ax.imshow(basemap.array, origin='upper', extent=basemap.extent, aspect='auto', interpolation='nearest')
+        self.ax.set_xlim(basemap.extent[0], basemap.extent[1])
+        self.ax.set_ylim(basemap.extent[2], basemap.extent[3])
+        self.path = self.ax.add_collection(LineCollection([], colors='g', linewidths=2))
+        self.points = self.ax.scatter([], [], s=6, c='r', zorder=3)
+        self.heat = self.ax.add_collection(LineCollection([], cmap='inferno', linewidths=1.5))
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def _save(self, artists, filename):
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for artist in artists:
+            self.ax.draw_artist(artist)
+        image = Image.fromarray(np.asarray(canvas.buffer_rgba())[..., :3])
+        if filename.lower().endswith('.png'):
+            image.save(filename, compress_level=self.compress_level)
+        else:
+            image.save(filename)
+
+    def render(self, traj, result, filename):
+        """ Save the GPS points of traj (GCJ-02 (lat, lon, ...) rows) and the matched roads of result. """
+        traj = np.asarray(traj, dtype=float)
+        if len(traj):
+            lat, lon = gcj2wgs_array(traj[:, 0], traj[:, 1])
+            self.points.set_offsets(np.column_stack([lon, lat]))
+        else:
+            self.points.set_offsets(np.empty((0, 2)))
+        roads = road_path(result) if result is not None else np.empty(0, dtype=np.int64)
+        self.path.set_segments(self.basemap.segments[roads])
+        self._save([self.path, self.points], filename)
+
+    def render_heatmap(self, counts, filename):
+        """ Save the edges colored by log(1 + count), e.g. `road_counts` of many trips. """
+        used = np.flatnonzero(counts)
+        self.heat.set_segments(self.basemap.segments[used])
+        self.heat.set_array(np.log1p(counts[used]))
+        self.heat.set_clim(0, np.log1p(counts.max()) if len(used) else 1)
+        self._save([self.heat], filename)
+
+
+def road_counts(results, n_edges):
+    """ Number of trips traversing every edge. """
+    counts = np.zeros(n_edges, dtype=np.int64)
+    for result in results:
+        if result is not None:
+            np.add.at(counts, np.unique(road_path(result)), 1)
+    return counts
+
+
+_renderer = None
+
+
+def _init_worker(basemap):
+    global _renderer
+    _renderer = TripRenderer(basemap)
+
+
+def _render_one(item):
+    filename, traj, result = item
+    _renderer.render(traj, result, filename)
+    return filename
+
+
+def render_many(basemap, items, out_dir, workers=None, chunksize=8, fmt='png'):
+    """ Render many trips over one basemap with a pool of worker processes, one reused figure per worker.
+
+    Args:
+    --------
+        basemap: Basemap
+        items: iterable of (name, traj, result), result being a matched trip or None
+        out_dir: directory of the images, `out_dir/name.fmt`
+        workers: number of processes, os.cpu_count() if None, in-process if <= 1
+        chunksize: trips sent to a worker at a time
+
+    Returns:
+    --------
+        The list of written files, in input order.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = ((os.path.join(out_dir, f'{name}.{fmt}'), traj, result) for name, traj, result in items)
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers <= 1:
+        _init_worker(basemap)
+        return [_render_one(job) for job in jobs]
+
+    methods = mp.get_all_start_methods()
+    ctx = mp.get_context('fork' if 'fork' in methods else None)
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(basemap,)) as pool:
+        return list(pool.imap(_render_one, jobs, chunksize=chunksize))
@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+
+# column -> dtype of the compact result, in the `match_traj(segment_projected=True)` frame order
+COLUMNS = {
+    'road': np.int32,
+    'obs': np.int32,
+    'obs_ne': np.uint8,
+    'timestamp': np.int64,  # ns since epoch
+    'longitude': np.float32,
+    'latitude': np.float32,
+    'length': np.float32,
+    'road_prop': np.float32,
+}
+
+
+class MatchedTrip:
+    __slots__ = list(COLUMNS) + ['part']
+
+    def __init__(self, road, obs, obs_ne, timestamp, longitude, latitude, length, road_prop, part=None):
+        """ Compact matched trip, one typed array per column of the projected match frame
+
+        Args:
+        --------
+            timestamp: int64 ns since epoch, or datetime64[ns]
+            part: int32 array, the preprocessing part of every row, or None
+        """
+        self.road = np.asarray(road, dtype=np.int32)
+        self.obs = np.asarray(obs, dtype=np.int32)
+        self.obs_ne = np.asarray(obs_ne, dtype=np.uint8)
+        timestamp = np.asarray(timestamp)
+        if timestamp.dtype.kind == 'M':
+            timestamp = timestamp.astype('datetime64[ns]').view(np.int64)
+        self.timestamp = timestamp.astype(np.int64, copy=False)
+        self.longitude = np.asarray(longitude, dtype=np.float32)
+        self.latitude = np.asarray(latitude, dtype=np.float32)
+        self.length = np.asarray(length, dtype=np.float32)
+        self.road_prop = np.asarray(road_prop, dtype=np.float32)
+        self.part = None if part is None else np.asarray(part, dtype=np.int32)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(*(df[col].to_numpy() for col in COLUMNS),
+                   part=df['part'].to_numpy() if 'part' in df.columns else None)
+
+    def __len__(self):
+        return len(self.road)
+
+    def columns(self):
+        columns = {col: getattr(self, col) for col in COLUMNS}
+        if self.part is not None:
+            columns['part'] = self.part
+        return columns
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns().values())
+
+    @property
+    def start(self):
+        return pd.Timestamp(int(self.timestamp.min()))
+
+    @property
+    def end(self):
+        return pd.Timestamp(int(self.timestamp.max()))
+
+    def route_length(self):
+        """ Summed length in meters of the distinct roads, in the order first matched. """
+        _, first = np.unique(self.road, return_index=True)
+        return float(self.length[first].astype(np.float64).sum())
+
+    def to_frame(self):
+        columns = self.columns()
+        columns['timestamp'] = columns['timestamp'].view('datetime64[ns]')
+        return pd.DataFrame(columns)
+
+    def to_route(self):
+        """ Edge traversals of the trip, see `compress_route`. """
+        columns = compress_route(self.road, self.timestamp, self.road_prop, self.length, self.obs_ne, self.part)
+        for col in ('entry_time', 'exit_time'):
+            columns[col] = columns[col].view('datetime64[ns]')
+        return pd.DataFrame(columns)
+
+
+def compress_route(road, timestamp, road_prop, length, obs_ne, part=None):
+    """ Collapse consecutive rows on the same road into edge traversals.
+
+    The time a trip leaves a road and enters the next one is interpolated between the last row on the
+    first road and the first row on the next, in proportion to the distance left on the first road and
+    the distance covered on the next. The first and last traversal, and the ones next to a change of
+    `part`, start or end at their rows.
+
+    Args:
+    --------
+        road, timestamp (int64 ns), road_prop, length, obs_ne: the per-row arrays of a matched trip
+        part: preprocessing part of every row or None
+
+    Returns:
+    --------
+        dict of arrays, one entry per traversal: road, entry_time and exit_time (int64 ns), travel_time (s),
+        entry_prop, exit_prop, distance (meters driven on the road), speed (m/s, nan for zero travel time),
+        n_obs (emitting rows), and part if given
+    """
+    n = len(road)
+    if n == 0:
+        raise ValueError("empty trip")
+    t = np.asarray(timestamp, dtype=np.int64)
+    road_prop = np.asarray(road_prop, dtype=np.float64)
+    length = np.asarray(length, dtype=np.float64)
+
+    change = np.ones(n, dtype=bool)
+    change[1:] = road[1:] != road[:-1]
+    joined = np.ones(n - 1, dtype=bool)
+    if part is not None:
+        joined = part[1:] == part[:-1]
+        change[1:] |= ~joined
+    first = np.flatnonzero(change)
+    last = np.append(first[1:] - 1, n - 1)
+    joined = joined[first[1:] - 1]
+
+    # crossing time between traversal k and k + 1
+    left = (1.0 - road_prop[last[:-1]]) * length[last[:-1]]
+    covered = road_prop[first[1:]] * length[first[1:]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(left + covered > 0, left / (left + covered), 0.5)
+    t_out, t_in = t[last[:-1]], t[first[1:]]
+    crossing = t_out + np.round((t_in - t_out) * share).astype(np.int64)
+
+    entry_time = t[first].copy()
+    exit_time = t[last].copy()
+    entry_prop = road_prop[first].copy()
+    exit_prop = road_prop[last].copy()
+    entry_time[1:][joined] = crossing[joined]
+    exit_time[:-1][joined] = crossing[joined]
+    entry_prop[1:][joined] = 0.0
+    exit_prop[:-1][joined] = 1.0
+
+    travel_time = (exit_time - entry_time) / 1e9
+    distance = np.clip(exit_prop - entry_prop, 0.0, None) * length[first]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = np.where(travel_time > 0, distance / travel_time, np.nan)
+    columns = {
+        'road': np.asarray(road)[first],
+        'entry_time': entry_time,
+        'exit_time': exit_time,
+        'travel_time': travel_time,
+        'entry_prop': entry_prop,
+        'exit_prop': exit_prop,
+        'distance': distance,
+        'speed': speed,
+        'n_obs': np.add.reduceat((np.asarray(obs_ne) == 0).astype(np.int64), first),
+    }
+    if part is not None:
+        columns['part'] = np.asarray(part)[first]
+    return columns
+
+
+def route_frame(trip):
+    """ Edge traversals of a matched trip, a `match_traj(segment_projected=True)` DataFrame or MatchedTrip. """
+    if isinstance(trip, pd.DataFrame):
+        trip = MatchedTrip.from_frame(trip)
+    return trip.to_route()
+
+
+class MatchedBatch:
+    __slots__ = ['trips', 'offsets', 'trip_ids', '_columns']
+
+    def __init__(self, trips, trip_ids=None):
+        """ Ragged batch of MatchedTrip
+
+        The batch only keeps references to the trips; the column arrays of the whole batch, trip i
+        being rows `offsets[i]:offsets[i + 1]`, are concatenated on first access.
+
+        Args:
+        --------
+            trips: list of MatchedTrip
+            trip_ids: one id per trip for the `trip` column, positions if None
+        """
+        self.trips = list(trips)
+        self.offsets = np.zeros(len(self.trips) + 1, dtype=np.int64)
+        np.cumsum([len(trip) for trip in self.trips], out=self.offsets[1:])
+        self.trip_ids = np.arange(len(self.trips)) if trip_ids is None else np.asarray(trip_ids)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.trips)
+
+    def __getitem__(self, i):
+        return self.trips[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def column(self, name):
+        if name not in self._columns:
+            if name == 'trip':
+                values = np.repeat(self.trip_ids, self.lengths)
+            elif name == 'seq_i':
+                values = np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], self.lengths)
+            else:
+                values = np.concatenate([getattr(trip, name) for trip in self.trips]) if self.trips \
+                    else np.empty(0, dtype=COLUMNS[name])
+            self._columns[name] = values
+        return self._columns[name]
+
+    def _names(self):
+        names = ['seq_i'] + list(COLUMNS)
+        if self.trips and all(trip.part is not None for trip in self.trips):
+            names.append('part')
+        return names + ['trip']
+
+    def to_frame(self):
+        """ One frame with `seq_i` (row in the trip) and `trip` columns, the layout of the exported trips. """
+        columns = {name: self.column(name) for name in self._names()}
+        columns['timestamp'] = columns['timestamp'].view('datetime64[ns]')
+        return pd.DataFrame(columns)
+
+    def to_arrow(self):
+        import pyarrow as pa
+
+        columns = {name: self.column(name) for name in self._names()}
+        columns['timestamp'] = pa.array(columns['timestamp'], type=pa.timestamp('ns'))
+        return pa.table(columns)
@@ -0,0 +1,189 @@
+import heapq
+import sys
+from collections import OrderedDict
+
+import numpy as np
+from leuvenmapmatching.matcher.distance import DistanceMatcher
+
+from geometry import haversine
+from .shared import CsrEdgeMap
+
+
+class TransitionCache:
+    def __init__(self, map_arrays, labels, capacity=100000, max_dist=2000.0):
+        """ Bounded LRU cache of edge-to-edge network distances over the map adjacency
+
+        The distance of a pair of edges (a, b) -> (c, d) is the route length from a to c: the length of the
+        first edge plus the shortest path from b to c, 0 for the same edge. Paths longer than max_dist
+        are not searched and cached as inf. Entries of `precompute` are kept apart and never evicted.
+
+        Args:
+        --------
+            map_arrays: `LeuvenMatcher.map_arrays`, GCJ-02 node coordinates and CSR adjacency
+            labels: node label of every row of map_arrays
+            capacity: number of LRU entries
+            max_dist: meters, cutoff of the shortest path search
+        """
+        self.indptr, self.indices = map_arrays['indptr'], map_arrays['indices']
+        gcj = map_arrays['gcj']
+        src = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        # straight node to node lengths, the same segments the HMM projects on
+        self.lengths = haversine(gcj[src, 1], gcj[src, 0], gcj[self.indices, 1], gcj[self.indices, 0])
+        self.labels = list(labels)
+        self.rows = {label: row for row, label in enumerate(self.labels)}
+        self.edge_lengths = dict(zip(zip([self.labels[i] for i in src.tolist()],
+                                         [self.labels[i] for i in self.indices.tolist()]), self.lengths.tolist()))
+        self.capacity = capacity
+        self.max_dist = max_dist
+        self.table = {}
+        self.clear()
+
+    def use_index(self, index, lengths):
+        """ Look rows and edge lengths up through a `shared.LabelIndex` and an edge length array over the CSR
+        entries, e.g. in shared memory, instead of the per-process dicts.
+        """
+        self.lengths = lengths
+        self.labels = index.labels
+        self.rows = index
+        self.edge_lengths = CsrEdgeMap(index, self.indptr, self.indices, lengths)
+
+    def clear(self):
+        self._lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, l1, l2, l3, l4):
+        key = (l1, l2, l3, l4)
+        dist = self.table.get(key)
+        if dist is not None:
+            self.hits += 1
+            return dist
+        dist = self._lru.get(key)
+        if dist is not None:
+            self.hits += 1
+            self._lru.move_to_end(key)
+            return dist
+        self.misses += 1
+        dist = self._compute(l1, l2, l3, l4)
+        self._lru[key] = dist
+        if len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+        return dist
+
+    def _compute(self, l1, l2, l3, l4):
+        if (l1, l2) == (l3, l4):
+            return 0.0
+        length = self.edge_lengths[(l1, l2)]
+        if l2 == l3:
+            return length
+        return length + self.shortest_paths(self.rows[l2], self.max_dist).get(self.rows[l3], np.inf)
+
+    def shortest_paths(self, source, cutoff):
+        """ Dijkstra from a node row, {row: meters} of the rows within cutoff. """
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for k in range(self.indptr[u], self.indptr[u + 1]):
+                v, dv = self.indices[k], d + self.lengths[k]
+                if dv <= cutoff and dv < dist.get(v, np.inf):
+                    dist[v] = dv
+                    heapq.heappush(heap, (dv, v))
+        return dist
+
+    def precompute(self, radius):
+        """ Fill the pinned table with every pair of edges whose route gap is within radius meters. """
+        indptr, indices, labels = self.indptr.tolist(), self.indices.tolist(), np.asarray(self.labels).tolist()
+        for u in range(len(indptr) - 1):
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                for w, gap in self.shortest_paths(v, radius).items():
+                    for j in range(indptr[w], indptr[w + 1]):
+                        if w == u and indices[j] == v:
+                            continue  # the same edge is 0, see _compute
+                        self.table[(labels[u], labels[v], labels[w], labels[indices[j]])] = self.lengths[k] + gap
+        return len(self.table)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def nbytes(self):
+        """ Approximate memory of the LRU entries and the pinned table. """
+        entries = len(self._lru) + len(self.table)
+        key = next(iter(self._lru), None) or next(iter(self.table), None)
+        per_entry = sys.getsizeof(key) + sys.getsizeof(0.0) if key is not None else 0
+        return sys.getsizeof(self._lru) + sys.getsizeof(self.table) + entries * per_entry
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'entries': len(self._lru),
+                'table_entries': len(self.table), 'nbytes': self.nbytes}
+
+
+class RoutedDistanceMatcher(DistanceMatcher):
+    def __init__(self, *args, transition_cache=None, routed_gaps=False, **kwargs):
+        """ DistanceMatcher whose transitions measure the distance between states along the network
+
+        d_s of a transition is taken from the TransitionCache route length between the two edges
+        and the positions on them, instead of great circle distances between the interpolated points.
+        On the same and on connected edges both are equal, and the pair lookup replaces the haversine
+        calls. Everything else is DistanceMatcher.logprob_trans, so scores are unchanged by default.
+
+        Args:
+        --------
+            transition_cache: TransitionCache of the map, plain DistanceMatcher transitions if None
+            routed_gaps: edges that are not connected get the route length between them instead of the
+                straight line, if there is a route; this changes scores and is off by default
+        """
+        super().__init__(*args, **kwargs)
+        self.transition_cache = transition_cache
+        self.routed_gaps = routed_gaps
+
+    def logprob_trans(self, prev_m, edge_m, edge_o, is_prev_ne=False, is_next_ne=False):
+        prev_e = prev_m.edge_m
+        if self.transition_cache is None or prev_e.l2 is None or edge_m.l2 is None:
+            return super().logprob_trans(prev_m, edge_m, edge_o, is_prev_ne, is_next_ne)
+
+        d_z = self.map.distance(prev_m.edge_o.pi, edge_o.pi)
+        is_same_edge = prev_e.l1 == edge_m.l1 and prev_e.l2 == edge_m.l2
+        is_reverse_edge = prev_e.l1 == edge_m.l2 and prev_e.l2 == edge_m.l1
+        d_x = None
+        if is_same_edge:
+            d_x = abs(edge_m.ti - prev_e.ti) * self.transition_cache.edge_lengths[(prev_e.l1, prev_e.l2)]
+        elif not is_reverse_edge and self.exact_dt_s and (self.routed_gaps or prev_e.l2 == edge_m.l1):
+            route = self.transition_cache.get(prev_e.l1, prev_e.l2, edge_m.l1, edge_m.l2)
+            if route < np.inf:
+                d_x = (route - prev_e.ti * self.transition_cache.edge_lengths[(prev_e.l1, prev_e.l2)]
+                       + edge_m.ti * self.transition_cache.edge_lengths[(edge_m.l1, edge_m.l2)])
+        if d_x is None:
+            d_x = self.map.distance(prev_e.pi, edge_m.pi)
+
+        if is_next_ne:
+            d_z += prev_m.d_o
+            d_x += prev_m.d_s
+
+        d_t = abs(d_z - d_x)
+        beta = self.beta_ne if is_prev_ne or is_next_ne else self.beta
+        logprob = -d_t ** 2 / beta
+
+        # penalties as in DistanceMatcher.logprob_trans; with routed_gaps, not connected edges are
+        # still penalized on top of the route length
+        if is_same_edge:
+            if self.avoid_goingback and edge_m.ti < prev_e.ti:
+                logprob += self.gobackonedge_factor_log
+        elif is_reverse_edge:
+            if self.avoid_goingback:
+                logprob += self.gobackonedge_factor_log
+        elif prev_e.l2 != edge_m.l1:
+            logprob += self.notconnectededges_factor_log
+        elif self.avoid_goingback:
+            for m in prev_m.prev:
+                if m.edge_m.l1 == edge_m.l1 and m.edge_m.l2 == edge_m.l2:
+                    logprob += self.gobacktoedge_factor_log
+                    break
+
+        return logprob, {'d_o': d_z, 'd_s': d_x, 'lpt': logprob}
@@ -0,0 +1,386 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from . import batch
+from .metrics import MatchMetrics
+from .result import MatchedBatch, MatchedTrip
+
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """ The request queue has no room for the trajectories of a request. """
+
+
+class TooLarge(Exception):
+    """ A request has more trajectories than the request queue can ever hold. """
+
+
+class _Item:
+    __slots__ = ['traj', 'future', 'enqueued']
+
+    def __init__(self, traj, future, enqueued):
+        self.traj = traj
+        self.future = future
+        self.enqueued = enqueued
+
+
+def _match_batch(trajs):
+    # runs in a pool worker set up by batch._init_worker
+    return [batch.match_item(batch._matcher, i, traj, batch._match_kwargs) for i, traj in enumerate(trajs)]
+
+
+def _warm(_):
+    return os.getpid()
+
+
+class MatchService:
+    def __init__(self, matcher, workers=None, max_batch=8, max_batch_points=2000, max_delay=0.002, queue_size=256,
+                 timeout=30.0, max_body=64 << 20, **match_kwargs):
+        """ Asyncio front end matching trajectories in a pool of warm worker processes
+
+        Trajectories of all requests go through one bounded queue. A batcher takes up to max_batch of them and
+        max_batch_points points, waiting at most max_delay for more, and sends them to a worker as one task.
+        The points bound keeps a short trajectory from waiting behind many long ones in the same task. At most two batches per
+        worker are in flight, so under overload the queue fills up and new requests are rejected at once
+        (`Overloaded`, HTTP 503) instead of queueing without bound. A request not answered within timeout
+        seconds fails (HTTP 504); its trajectories still waiting in the queue are skipped. A request with more
+        trajectories than queue_size fails at once (`TooLarge`, HTTP 413), and a failing worker gives HTTP 500,
+        or 503 once the pool is broken.
+
+        HTTP endpoints (`serve`):
+            POST /match  JSON {"trajs": [[[lat, lon, t], ...], ...]} (or "traj": one trajectory), answers
+                {"results": [{"error": null | reason, "columns": {column: values}}]}; or an Arrow IPC stream
+                with trip, lat, lon, t columns, answered with the rows of the matched trips as an Arrow stream
+                and the unmatched trip ids in the X-Unmatched header
+            GET /metrics  service and matching metrics, see `snapshot`
+            GET /health
+
+        Args:
+        --------
+            matcher: an initialized matcher, forked into every worker; instrument it for the matching metrics
+            workers: number of processes, os.cpu_count() if None
+            max_batch: trajectories sent to a worker at a time
+            max_batch_points: points of a batch, a batch takes trajectories until it reaches it
+            max_delay: seconds the batcher waits to fill a batch
+            queue_size: trajectories waiting for a worker
+            timeout: seconds per request
+            max_body: bytes of a request body
+            match_kwargs: forwarded to `match_traj`, segment_projected=True and compact=True by default
+        """
+        if matcher.matcher is None:
+            raise ValueError("matcher not initialized")
+        self.matcher = matcher
+        self.workers = workers or os.cpu_count()
+        self.max_batch = max_batch
+        self.max_batch_points = max_batch_points
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_body = max_body
+        self.match_kwargs = dict({'segment_projected': True, 'compact': True}, **match_kwargs)
+        # counters: requests, trajectories, rejected, timeouts, failed_requests, batches, failed_batches;
+        # histograms: time.request, time.queue, time.batch (seconds), batch_size
+        self.metrics = MatchMetrics()
+        self.executor = None
+        self.queue = None
+        self._slots = None
+        self._batcher = None
+        self._tasks = set()
+        self._writers = set()
+        self._started = None
+
+    async def start(self):
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context('fork' if 'fork' in methods else None)
+        with batch.frozen_heap():
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=batch._init_worker,
+                                                initargs=(self.matcher, self.match_kwargs))
+            loop = asyncio.get_running_loop()
+            # start every worker now rather than on the first requests
+            await asyncio.gather(*(loop.run_in_executor(self.executor, _warm, i) for i in range(self.workers)))
+        self.queue = asyncio.Queue(self.queue_size)
+        self._slots = asyncio.Semaphore(2 * self.workers)
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self._started = time.monotonic()
+        return self
+
+    async def close(self):
+        # idle keep-alive connections see end of file and their handlers return
+        for writer in list(self._writers):
+            writer.close()
+        if self._batcher is not None:
+            self._batcher.cancel()
+            self._batcher = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def match(self, trajs):
+        """ Match trajectories, returns one BatchResult per trajectory.
+
+        Raises TooLarge if they can never fit in the queue, Overloaded if the queue has no room for them now,
+        asyncio.TimeoutError after `timeout`.
+        """
+        loop = asyncio.get_running_loop()
+        t_start = loop.time()
+        self.metrics.counters['requests'] += 1
+        if len(trajs) > self.queue.maxsize:
+            self.metrics.counters['rejected'] += 1
+            raise TooLarge(f"{len(trajs)} trajectories, at most {self.queue.maxsize} per request")
+        if self.queue.maxsize - self.queue.qsize() < len(trajs):
+            self.metrics.counters['rejected'] += 1
+            raise Overloaded(f"{self.queue.qsize()} trajectories queued")
+        items = [_Item(traj, loop.create_future(), t_start) for traj in trajs]
+        for item in items:
+            self.queue.put_nowait(item)
+        self.metrics.counters['trajectories'] += len(items)
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(item.future for item in items)), self.timeout)
+        except asyncio.TimeoutError:
+            self.metrics.counters['timeouts'] += 1
+            raise
+        self.metrics.histogram('time.request').add(loop.time() - t_start)
+        return [res._replace(index=i) for i, res in enumerate(results)]
+
+    async def _batch_loop(self):
+        while True:
+            items = [await self.queue.get()]
+            points = len(items[0].traj)
+            if self.queue.qsize() < self.max_batch - 1 and self.max_delay > 0:
+                await asyncio.sleep(self.max_delay)
+            while len(items) < self.max_batch and points < self.max_batch_points and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                points += len(items[-1].traj)
+            # timed out requests cancelled their futures
+            items = [item for item in items if not item.future.done()]
+            if not items:
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run(items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items):
+        loop = asyncio.get_running_loop()
+        t_start = loop.time()
+        for item in items:
+            self.metrics.histogram('time.queue').add(t_start - item.enqueued)
+        try:
+            results = await loop.run_in_executor(self.executor, _match_batch, [item.traj for item in items])
+        except Exception as e:
+            self.metrics.counters['failed_batches'] += 1
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        self.metrics.counters['batches'] += 1
+        self.metrics.histogram('time.batch').add(loop.time() - t_start)
+        self.metrics.histogram('batch_size').add(len(items))
+        for item, res in zip(items, results):
+            if res.stats is not None:
+                self.matcher._emit(res.stats)
+            if not item.future.done():
+                item.future.set_result(res)
+
+    def snapshot(self):
+        """ Service metrics, the matcher's MatchMetrics snapshot if instrumented, queue state and throughput. """
+        uptime = time.monotonic() - self._started if self._started is not None else 0.0
+        service = self.metrics.snapshot()
+        return {
+            'uptime': uptime,
+            'workers': self.workers,
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'in_flight': len(self._tasks),
+            'trajectories_per_s': service['counters'].get('trajectories', 0) / uptime if uptime else 0.0,
+            'service': service,
+            'matching': self.matcher.metrics.snapshot() if self.matcher.metrics is not None else None,
+        }
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """ Start the HTTP front end, returns the asyncio.Server. """
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await _read_request(reader, self.max_body)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, content_type, payload, extra = await self._dispatch(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                _write_response(writer, status, content_type, payload, extra, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # a cancelled handler is a connection dropped at shutdown
+            pass
+        except _BadRequest as e:
+            _write_response(writer, e.status, 'application/json', json.dumps({'error': str(e)}).encode(), {}, False)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body):
+        path = path.split('?', 1)[0]
+        if path == '/health':
+            return 200, 'application/json', json.dumps({'status': 'ok', 'workers': self.workers}).encode(), {}
+        if path == '/metrics':
+            return 200, 'application/json', json.dumps(self.snapshot()).encode(), {}
+        if path != '/match':
+            return 404, 'application/json', b'{"error": "not found"}', {}
+        if method != 'POST':
+            return 405, 'application/json', b'{"error": "POST trajectories to /match"}', {}
+
+        arrow = headers.get('content-type', '').startswith(ARROW_TYPE)
+        try:
+            trip_ids, trajs = _parse_arrow(body) if arrow else (None, _parse_json(body))
+        except (ValueError, KeyError, TypeError) as e:
+            self.metrics.counters['failed_requests'] += 1
+            return 400, 'application/json', json.dumps({'error': f'{type(e).__name__}: {e}'}).encode(), {}
+        try:
+            results = await self.match(trajs)
+        except TooLarge as e:
+            return 413, 'application/json', json.dumps({'error': str(e)}).encode(), {}
+        except Overloaded as e:
+            return 503, 'application/json', json.dumps({'error': f'overloaded: {e}'}).encode(), {'Retry-After': '1'}
+        except asyncio.TimeoutError:
+            return 504, 'application/json', json.dumps({'error': f'timeout after {self.timeout} s'}).encode(), {}
+        except BrokenProcessPool as e:
+            logger.error("matching pool broken: %s", e)
+            self.metrics.counters['failed_requests'] += 1
+            return 503, 'application/json', json.dumps({'error': 'matching pool unavailable'}).encode(), {}
+        except Exception:
+            logger.exception("matching failed")
+            self.metrics.counters['failed_requests'] += 1
+            return 500, 'application/json', b'{"error": "internal error"}', {}
+        if arrow:
+            payload, unmatched = _arrow_response(trip_ids, results)
+            return 200, ARROW_TYPE, payload, {'X-Unmatched': ','.join(map(str, unmatched))}
+        return 200, 'application/json', json.dumps({'results': [_json_result(res) for res in results]}).encode(), {}
+
+
+class _BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_request(reader, max_body):
+    """ (method, path, headers, body) of the next HTTP/1.1 request on a connection, None on a clean close. """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise _BadRequest(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > max_body:
+        raise _BadRequest(413, f"body larger than {max_body} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def _write_response(writer, status, content_type, payload, extra, keep_alive):
+    head = [f'HTTP/1.1 {status} {_REASONS.get(status, "")}', f'Content-Type: {content_type}',
+            f'Content-Length: {len(payload)}', f'Connection: {"keep-alive" if keep_alive else "close"}']
+    head += [f'{name}: {value}' for name, value in extra.items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+
+
+def _parse_json(body):
+    request = json.loads(body)
+    trajs = request['trajs'] if 'trajs' in request else [request['traj']]
+    trajs = [np.asarray(traj, dtype=float) for traj in trajs]
+    for traj in trajs:
+        if traj.ndim != 2 or traj.shape[1] != 3 or len(traj) == 0:
+            raise ValueError("a trajectory is a non-empty list of [lat, lon, t]")
+    return trajs
+
+
+def _parse_arrow(body):
+    import pyarrow as pa
+
+    table = pa.ipc.open_stream(body).read_all()
+    trip = table.column('trip').to_numpy()
+    points = np.column_stack([table.column(col).to_numpy().astype(float) for col in ('lat', 'lon', 't')])
+    if len(trip) == 0:
+        raise ValueError("empty table")
+    # rows of a trip are contiguous
+    starts = np.flatnonzero(np.concatenate(([True], trip[1:] != trip[:-1])))
+    ends = np.append(starts[1:], len(trip))
+    return trip[starts].tolist(), [points[s:e] for s, e in zip(starts, ends)]
+
+
+def _columns(result):
+    if isinstance(result, MatchedTrip):
+        return result.columns()
+    columns = {}
+    for col in result.columns:
+        values = result[col].to_numpy()
+        columns[col] = values.astype('datetime64[ns]').view(np.int64) if values.dtype.kind == 'M' else values
+    return columns
+
+
+def _json_result(res):
+    if res.result is None:
+        return {'error': res.error, 'columns': None}
+    columns = {}
+    for col, values in _columns(res.result).items():
+        if values.dtype.kind == 'f' and np.isnan(values).any():
+            values = np.where(np.isnan(values), None, values)
+        columns[col] = values.tolist()
+    return {'error': None, 'columns': columns}
+
+
+def _arrow_response(trip_ids, results):
+    import pyarrow as pa
+
+    matched = [(trip_id, res.result) for trip_id, res in zip(trip_ids, results) if res.result is not None]
+    unmatched = [trip_id for trip_id, res in zip(trip_ids, results) if res.result is None]
+    if matched and isinstance(matched[0][1], MatchedTrip):
+        table = MatchedBatch([trip for _, trip in matched], [trip_id for trip_id, _ in matched]).to_arrow()
+    else:
+        frames = [frame.assign(trip=trip_id) for trip_id, frame in matched]
+        table = pa.Table.from_pandas(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(),
+                                     preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as stream:
+        stream.write_table(table)
+    return sink.getvalue(), unmatched
@@ -0,0 +1,141 @@
+from bisect import bisect_left
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_ALIGN = 64
+
+
+class SharedArrays:
+    def __init__(self, arrays):
+        """ Named read-only numpy arrays packed into one shared memory block
+
+        Processes forked after the copy, or unpickling the object (which only carries the block name
+        and layout), see the same physical pages, so the arrays exist once however many workers use them.
+        The creating process owns the block and frees it with `unlink`.
+
+        Args:
+        --------
+            arrays: {name: array}
+        """
+        layout, size = {}, 0
+        for name, values in arrays.items():
+            values = np.asarray(values)
+            layout[name] = (size, values.dtype.str, values.shape)
+            size += -(-values.nbytes // _ALIGN) * _ALIGN
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.layout = layout
+        self.owner = True
+        self._views = {}
+        for name, values in arrays.items():
+            self._view(name, writeable=True)[...] = values
+
+    def _view(self, name, writeable=False):
+        offset, dtype, shape = self.layout[name]
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf, offset=offset)
+        view.flags.writeable = writeable
+        return view
+
+    def __getitem__(self, name):
+        if name not in self._views:
+            self._views[name] = self._view(name)
+        return self._views[name]
+
+    def __contains__(self, name):
+        return name in self.layout
+
+    def keys(self):
+        return self.layout.keys()
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.layout = state['layout']
+        self.owner = False
+        self._views = {}
+
+    def close(self):
+        self._views = {}
+        self.shm.close()
+
+    def unlink(self):
+        if self.owner:
+            self.shm.unlink()
+
+
+class LabelIndex:
+    def __init__(self, labels, order=None, sorted_labels=None):
+        """ Node label -> row lookup over arrays, replacing a per-process {label: row} dict
+
+        Lookups bisect memoryviews of the arrays, which index to Python ints without numpy scalar overhead.
+
+        Args:
+        --------
+            labels: int64 array, the label of every row
+            order, sorted_labels: argsort of labels and labels[order], computed if None
+        """
+        self.labels = labels
+        self.order = np.argsort(labels, kind='stable') if order is None else order
+        self.sorted = labels[self.order] if sorted_labels is None else sorted_labels
+        self._sorted = memoryview(np.ascontiguousarray(self.sorted))
+        self._order = memoryview(np.ascontiguousarray(self.order))
+
+    def to_arrays(self):
+        return {'labels': self.labels, 'label_order': self.order, 'labels_sorted': self.sorted}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get(self, label, default=None):
+        i = bisect_left(self._sorted, label)
+        if i < len(self._sorted) and self._sorted[i] == label:
+            return self._order[i]
+        return default
+
+    def __getitem__(self, label):
+        row = self.get(label)
+        if row is None:
+            raise KeyError(label)
+        return row
+
+    def __contains__(self, label):
+        return self.get(label) is not None
+
+
+class CsrEdgeMap:
+    def __init__(self, index, indptr, indices, values):
+        """ (label, label) -> value lookup of the directed edges of a CSR adjacency
+
+        Args:
+        --------
+            index: LabelIndex of the rows
+            indptr, indices: CSR adjacency over the rows
+            values: one value per CSR entry
+        """
+        self.index = index
+        self.indptr = memoryview(np.ascontiguousarray(indptr))
+        self.indices = memoryview(np.ascontiguousarray(indices))
+        self.values = memoryview(np.ascontiguousarray(values))
+
+    def get(self, edge, default=None):
+        src, dst = self.index.get(edge[0]), self.index.get(edge[1])
+        if src is None or dst is None:
+            return default
+        start = self.indptr[src]
+        nbrs = self.indices[start:self.indptr[src + 1]].tolist()
+        return self.values[start + nbrs.index(dst)] if dst in nbrs else default
+
+    def __getitem__(self, edge):
+        value = self.get(edge)
+        if value is None:
+            raise KeyError(edge)
+        return value
+
+    def __contains__(self, edge):
+        return self.get(edge) is not None
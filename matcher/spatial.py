@@ -0,0 +1,190 @@
+import numpy as np
+from leuvenmapmatching.map.inmem import InMemMap
+
+from geometry import R
+
+
+class SegmentGrid:
+    def __init__(self, lat, lon, src, dst, cell_size=250.0, origin=None, arrays=None):
+        """ Grid buckets over road segments in a local equirectangular plane (meters)
+
+        Every segment is put in all cells its bounding box touches, cells are stored in CSR form.
+
+        Args:
+        --------
+            lat, lon: node coordinates
+            src, dst: node rows of the segments
+            cell_size: cell side in meters
+            origin: (lat, lon) of the plane origin, the center of the nodes if None
+            arrays: `to_arrays` output of a grid over the same segments, skips the bucketing
+        """
+        if arrays is not None:
+            cell_size, lat0, lon0 = arrays['grid_meta'].tolist()
+            origin = (lat0, lon0)
+        self.lat, self.lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        self.src, self.dst = np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64)
+        self.cell_size = float(cell_size)
+        if origin is None:
+            origin = ((self.lat.min() + self.lat.max()) / 2, (self.lon.min() + self.lon.max()) / 2)
+        self.origin = origin
+        self.kx = np.cos(np.radians(origin[0]))
+        self.x, self.y = self.project(self.lat, self.lon)
+        self.x_min, self.y_min = self.x.min(), self.y.min()
+        self.shape = (int((self.x.max() - self.x_min) // cell_size) + 1, int((self.y.max() - self.y_min) // cell_size) + 1)
+        if arrays is None:
+            self._build()
+        else:
+            self.cell_ptr, self.cell_segments = arrays['grid_ptr'], arrays['grid_segments']
+
+    def project(self, lat, lon):
+        return (np.radians(np.subtract(lon, self.origin[1])) * R * self.kx,
+                np.radians(np.subtract(lat, self.origin[0])) * R)
+
+    def _cell(self, x, y):
+        ix = np.clip(((x - self.x_min) // self.cell_size).astype(np.int64), 0, self.shape[0] - 1)
+        iy = np.clip(((y - self.y_min) // self.cell_size).astype(np.int64), 0, self.shape[1] - 1)
+        return ix, iy
+
+    def _build(self):
+        xs, ys, xd, yd = self.x[self.src], self.y[self.src], self.x[self.dst], self.y[self.dst]
+        ix0, iy0 = self._cell(np.minimum(xs, xd), np.minimum(ys, yd))
+        ix1, iy1 = self._cell(np.maximum(xs, xd), np.maximum(ys, yd))
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        # enumerate the (ix, iy) cells of every bounding box
+        segment = np.repeat(np.arange(len(self.src)), nx * ny)
+        k = np.arange(len(segment)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+        cell = (ix0[segment] + k // ny[segment]) * self.shape[1] + iy0[segment] + k % ny[segment]
+        order = np.argsort(cell, kind='stable')
+        self.cell_segments = segment[order]
+        self.cell_ptr = np.zeros(self.shape[0] * self.shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=self.shape[0] * self.shape[1]), out=self.cell_ptr[1:])
+
+    def query(self, lat, lon, radius):
+        """ Segments within radius meters of a point, nearest first.
+
+        Returns:
+        --------
+            segment indices and their distances in meters
+        """
+        x, y = self.project(lat, lon)
+        (ix0, ix1), (iy0, iy1) = self._cell(np.array([x - radius, x + radius]), np.array([y - radius, y + radius]))
+        cells = (np.arange(ix0, ix1 + 1)[:, None] * self.shape[1] + np.arange(iy0, iy1 + 1)).ravel()
+        starts, ends = self.cell_ptr[cells], self.cell_ptr[cells + 1]
+        if ends.sum() == starts.sum():
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        segments = np.unique(np.concatenate([self.cell_segments[s:e] for s, e in zip(starts, ends)]))
+
+        xs, ys = self.x[self.src[segments]], self.y[self.src[segments]]
+        sx, sy = self.x[self.dst[segments]] - xs, self.y[self.dst[segments]] - ys
+        seg2 = sx * sx + sy * sy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip(np.where(seg2 > 0, ((x - xs) * sx + (y - ys) * sy) / seg2, 0.0), 0.0, 1.0)
+        dist = np.hypot(x - xs - t * sx, y - ys - t * sy)
+        near = dist <= radius
+        order = np.argsort(dist[near], kind='stable')
+        return segments[near][order], dist[near][order]
+
+    def to_arrays(self):
+        return {'grid_ptr': self.cell_ptr, 'grid_segments': self.cell_segments,
+                'grid_meta': np.array([self.cell_size, self.origin[0], self.origin[1]])}
+
+
+class IndexedMap(InMemMap):
+    """ InMemMap whose `edges_closeto` queries a SegmentGrid instead of scanning every node """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.grid = None
+        self.labels = None
+        self.n_queries = 0
+        self.n_candidates = 0
+        self.last_candidates = 0
+
+    def set_index(self, grid, labels):
+        # labels: node label of every grid node row
+        self.grid = grid
+        self.labels = labels
+
+    def _row_label(self, row):
+        return self.labels[row]
+
+    def _row_location(self, row):
+        return self.graph[self.labels[row]][0]
+
+    def edges_closeto(self, loc, max_dist=None, max_elmt=None):
+        if self.grid is None or max_dist is None or not np.isfinite(max_dist):
+            results = super().edges_closeto(loc, max_dist=max_dist, max_elmt=max_elmt)
+            self._count(results)
+            return results
+        # the plane is a close approximation, distances are recomputed like InMemMap does on a margin
+        segments, _ = self.grid.query(loc[0], loc[1], max_dist * 1.01 + 1.0)
+        results = []
+        for src, dst in zip(self.grid.src[segments].tolist(), self.grid.dst[segments].tolist()):
+            label, nbr = self._row_label(src), self._row_label(dst)
+            if label == nbr:
+                continue
+            oloc, nloc = self._row_location(src), self._row_location(dst)
+            dist, pi, ti = self.distance_point_to_segment(loc, oloc, nloc)
+            if dist < max_dist:
+                results.append((dist, label, oloc, nbr, nloc, pi, ti))
+        results.sort()
+        if max_elmt is not None:
+            results = results[:max_elmt]
+        self._count(results)
+        return results
+
+    def _count(self, results):
+        self.n_queries += 1
+        self.n_candidates += len(results)
+        self.last_candidates = len(results)
+
+
+class ArrayMap(IndexedMap):
+    def __init__(self, name, index, gcj, indptr, indices, grid):
+        """ IndexedMap over the CSR arrays of the map instead of the InMemMap graph dict
+
+        Lookups go through the arrays, which can live in shared memory (`matcher.shared.SharedArrays`),
+        so a process holds no per-node Python objects. Answers are the same as the InMemMap the arrays
+        were built from, neighbors in the same order.
+
+        Args:
+        --------
+            name: map name
+            index: `matcher.shared.LabelIndex` of the node labels, rows follow gcj
+            gcj: (n, 2) [lat, lon] node coordinates
+            indptr, indices: CSR adjacency over the rows
+            grid: SegmentGrid over the same rows
+        """
+        super().__init__(name, use_latlon=True)
+        self.index = index
+        self.gcj = gcj
+        self.indptr = indptr
+        self.indices = indices
+        self.set_index(grid, index.labels)
+
+    def _row_label(self, row):
+        return self.labels[row].item()
+
+    def _row_location(self, row):
+        return tuple(self.gcj[row].tolist())
+
+    def size(self):
+        return len(self.index)
+
+    def node_coordinates(self, node_key):
+        return self._row_location(self.index[node_key])
+
+    def nodes_nbrto(self, node):
+        row = self.index.get(node)
+        if row is None:
+            return []
+        rows = self.indices[self.indptr[row]:self.indptr[row + 1]].tolist() + [row]
+        return [(label, tuple(loc)) for label, loc in zip(self.index.labels[rows].tolist(), self.gcj[rows].tolist())]
+
+    def all_nodes(self, bb=None):
+        return [(label, tuple(loc)) for label, loc in zip(self.index.labels.tolist(), self.gcj.tolist())]
+
+    def all_edges(self, bb=None):
+        src = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        labels, locs = self.index.labels.tolist(), self.gcj.tolist()
+        return [(labels[a], tuple(locs[a]), labels[b], tuple(locs[b])) for a, b in zip(src.tolist(), self.indices.tolist())]
@@ -0,0 +1,101 @@
+import numpy as np
+
+from geometry import haversine
+
+
+def split_runs(mask):
+    """
+    Index arrays of the runs of consecutive True values in a boolean mask
+    """
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    return [np.arange(start, end) for start, end in zip(edges[::2], edges[1::2])]
+
+
+def clip_to_bounds(lat, lon, bounds):
+    """
+    Split a trajectory into the runs of points inside bounds [min_lon, max_lon, min_lat, max_lat]
+    """
+    min_lon, max_lon, min_lat, max_lat = bounds
+    return split_runs((lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat))
+
+
+def first_per_bin(bins):
+    """
+    Mask of the first point of every bin of a non-decreasing bin number array, the last point is always kept
+    """
+    keep = np.ones(len(bins), dtype=bool)
+    keep[1:] = bins[1:] != bins[:-1]
+    keep[-1] = True
+    return keep
+
+
+def distance_mask(lat, lon, min_dist):
+    """
+    Keep the first point of every min_dist meters along the path, which removes duplicate and stationary
+    fixes and downsamples dense trips. Jitter within min_dist accumulates, so slow movement is still sampled.
+    """
+    step = haversine(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    travelled = np.concatenate(([0.0], np.cumsum(step)))
+    return first_per_bin(np.floor(travelled / min_dist))
+
+
+def interval_mask(t, min_interval):
+    """
+    Keep the first point of every min_interval seconds
+    """
+    return first_per_bin(np.floor((t - t[0]) / min_interval))
+
+
+def speed_outlier_mask(lat, lon, t, max_speed):
+    """
+    Mask of the points reached and left faster than max_speed m/s, i.e. isolated position spikes
+    """
+    step = haversine(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    dt = np.diff(t)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fast = np.where(dt > 0, step / dt, np.where(step > 0, np.inf, 0.0)) > max_speed
+    outlier = np.zeros(len(t), dtype=bool)
+    outlier[1:-1] = fast[:-1] & fast[1:]
+    return outlier
+
+
+def preprocess(traj, bounds=None, min_dist=None, min_interval=None, max_speed=None, min_points=2):
+    """ Clean a trajectory before map matching.
+
+    Steps: clip and split against bounds, drop speed outliers, drop duplicate/stationary points and
+    downsample by distance, downsample by time. The first and last point of every part are kept by the
+    downsampling steps.
+
+    Args:
+    --------
+        traj: array-like of (lat, lon) or (lat, lon, t) rows, the `match_traj` format
+        bounds: [min_lon, max_lon, min_lat, max_lat] in the trajectory coordinates, no clipping if None
+        min_dist: meters, see `distance_mask`
+        min_interval: seconds between kept points, needs timestamps
+        max_speed: m/s, see `speed_outlier_mask`, needs timestamps
+        min_points: parts with fewer points are discarded
+
+    Returns:
+    --------
+        A list of index arrays into traj, one per part, so that traj[index] is the cleaned part and
+        matched observations map back to the original points.
+    """
+    traj = np.asarray(traj, dtype=float)
+    lat, lon = traj[:, 0], traj[:, 1]
+    timed = traj.shape[1] > 2
+    if (min_interval is not None or max_speed is not None) and not timed:
+        raise ValueError("min_interval and max_speed need timestamps")
+
+    parts = clip_to_bounds(lat, lon, bounds) if bounds is not None else [np.arange(len(traj))]
+    cleaned = []
+    for index in parts:
+        if len(index) > 2 and max_speed is not None:
+            index = index[~speed_outlier_mask(lat[index], lon[index], traj[index, 2], max_speed)]
+        if len(index) > 1 and min_dist is not None:
+            index = index[distance_mask(lat[index], lon[index], min_dist)]
+        if len(index) > 1 and min_interval is not None:
+            index = index[interval_mask(traj[index, 2], min_interval)]
+        if len(index) >= min_points:
+            cleaned.append(index)
+    return cleaned
@@ -0,0 +1,280 @@
+""" Resumable batch map matching of trajectory csv files into a parquet dataset
+
+The input files are split into byte range shards, each shard writes its own part files
+(`shard-00003-00000.parquet`, ...) through a TripSink. After every parsed chunk is matched and flushed, the
+shard's next input offset and part count are committed to `<output>/_checkpoint.json`. A rerun with the
+same settings skips the finished shards, removes the part files written after the last commit and goes
+on from the committed offsets, so an interrupted job neither redoes nor duplicates committed work.
+
+Usage:
+    python run_matching.py --city chengdu --data-dir /data/traj/ --input chengdushi_1001_1010.csv \
+        --output exports/chengdu01 --workers 8
+    python run_matching.py --config job.json
+
+The config file is a JSON object with any of the options below (`graph`, `bgimg`, `extent`, `input`, ...),
+command line options take precedence over it, and it over the city presets. It can also set `profiles`, the
+matcher profile cascade ({name: matcher_params overrides}, see `LeuvenMatcher.matcher_profiles`).
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import warnings
+from collections import deque
+
+from matcher.leuven_mapmatcher import LeuvenMatcher
+from trajectory import read_trajs_range, shard_ranges
+from export import TripSink
+
+warnings.filterwarnings('ignore')
+logging.getLogger("be.kuleuven.cs.dtai.mapmatching").setLevel(logging.ERROR)
+
+CITIES = {
+    'chengdu': {'graph': 'data/chengdu_graph.pkl', 'bgimg': 'data/chengdu_bound.jpg',
+                'extent': [104.0421, 104.1291, 30.6528, 30.7265],
+                # LeuvenMatcher.matcher_profiles and a last, widest one: matches every bundled trajectory
+                'profiles': {'narrow': {'max_lattice_width': 3},
+                             'wide': {'obs_noise': 200, 'obs_noise_ne': 200, 'dist_noise': 1000, 'max_dist_init': 1000},
+                             'widest': {'max_lattice_width': 10, 'obs_noise': 300, 'obs_noise_ne': 300,
+                                        'dist_noise': 2000, 'max_dist_init': 1000}}},
+    'xian': {'graph': 'data/xian_graph.pkl', 'bgimg': 'data/xian_bound.jpg',
+             'extent': [108.9219, 109.0100, 34.2049, 34.2786]},
+}
+
+DEFAULTS = {'city': None, 'graph': None, 'bgimg': None, 'extent': [], 'data_dir': '', 'input': [], 'output': None,
+            'workers': os.cpu_count(), 'chunksize': 16, 'shard_size': 256 << 20, 'chunk_size': 16 << 20,
+            'cache_dir': None, 'mode': 'rows', 'preprocess': False, 'windowed': False, 'all_points': False,
+            'profiles': None}
+
+# options that change what is written, a checkpoint only resumes a job with the same values
+JOB_KEYS = ['city', 'graph', 'input', 'shard_size', 'mode', 'preprocess', 'windowed', 'all_points', 'profiles']
+
+CHECKPOINT = '_checkpoint.json'
+
+
+class _Pending:
+    __slots__ = ['shard', 'offset', 'driver_ids', 'n_done', 'n_matched']
+
+    def __init__(self, shard, offset, driver_ids):
+        # a parsed chunk of a shard whose results are not all consumed yet, offset is where the next chunk starts
+        self.shard = shard
+        self.offset = offset
+        self.driver_ids = driver_ids
+        self.n_done = 0
+        self.n_matched = 0
+
+
+def load_config(args):
+    """ Merge the defaults, the city preset, the config file and the command line options. """
+    config = dict(DEFAULTS)
+    given = {key: value for key, value in vars(args).items() if value is not None and key not in ('config', 'restart')}
+    file_config = {}
+    if args.config:
+        with open(args.config) as fp:
+            file_config = json.load(fp)
+    city = given.get('city', file_config.get('city'))
+    if city is not None:
+        if city not in CITIES and 'graph' not in file_config and 'graph' not in given:
+            raise ValueError(f"Unknown city {city} without a graph, expected one of {sorted(CITIES)}.")
+        config.update(CITIES.get(city, {}))
+    config.update(file_config)
+    config.update(given)
+    if config['graph'] is None or not config['input'] or config['output'] is None:
+        raise ValueError("graph, input and output are required")
+    if config['mode'] not in ('rows', 'routes'):
+        raise ValueError(f"Unknown mode {config['mode']}, expected 'rows' or 'routes'.")
+    return config
+
+
+def plan_shards(config):
+    """ [(file, start, end)] byte ranges of all input files, in input order. """
+    shards = []
+    for file in config['input']:
+        filename = os.path.join(config['data_dir'], file)
+        shards.extend((filename, start, end) for start, end in shard_ranges(os.path.getsize(filename), config['shard_size']))
+    return shards
+
+
+def fingerprint(config, shards):
+    job = {key: config[key] for key in JOB_KEYS}
+    job['shards'] = [(os.path.basename(filename), start, end) for filename, start, end in shards]
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+class Checkpoint:
+    def __init__(self, output, key, n_shards, restart=False):
+        """ Committed progress of a job, one entry per shard
+
+        Every shard entry has the committed input `offset`, the number of committed `parts`, and the
+        `trajs` and `matched` counts. `done` is set once the whole byte range is committed.
+
+        Args:
+        --------
+            output: dataset directory
+            key: job fingerprint, a checkpoint of another job is refused
+            n_shards: number of shards of the job
+            restart: discard an existing checkpoint and its part files instead
+        """
+        self.filename = os.path.join(output, CHECKPOINT)
+        self.output = output
+        state = None
+        if os.path.exists(self.filename):
+            with open(self.filename) as fp:
+                state = json.load(fp)
+            if restart:
+                for shard in range(len(state['shards'])):
+                    self.remove_parts(shard, 0)
+                state = None
+            elif state['key'] != key:
+                raise ValueError(f"{self.filename} belongs to a job with other settings, "
+                                 "use another output directory or --restart")
+        if state is None:
+            state = {'key': key, 'shards': [{'offset': None, 'parts': 0, 'trajs': 0, 'matched': 0, 'done': False}
+                                            for _ in range(n_shards)]}
+        self.state = state
+        self.shards = state['shards']
+
+    def remove_parts(self, shard, first):
+        """ Delete the part files of a shard from sequence number `first` on, i.e. the uncommitted ones. """
+        prefix = shard_prefix(shard)
+        for table in ('trips', 'trip_info'):
+            if not os.path.isdir(os.path.join(self.output, table)):
+                continue
+            for name in os.listdir(os.path.join(self.output, table)):
+                if name.startswith(prefix + '-') and int(name[len(prefix) + 1:].split('.')[0]) >= first:
+                    os.remove(os.path.join(self.output, table, name))
+
+    def commit(self, shard, offset, parts, trajs, matched, done=False):
+        entry = self.shards[shard]
+        entry.update(offset=offset, parts=parts, trajs=entry['trajs'] + trajs, matched=entry['matched'] + matched,
+                     done=done)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.filename)
+
+
+def shard_prefix(shard):
+    return f'shard-{shard:05d}'
+
+
+def trip_info(trip_id, res, driver_id, mode):
+    if mode == 'routes':
+        return [trip_id, res['entry_time'].min(), res['exit_time'].max(), res['distance'].sum() / 1000, driver_id]
+    return [trip_id, res.start, res.end, res.route_length() / 1000, driver_id]
+
+
+def run(config, restart=False):
+    """ Match the input of a config into its output dataset, resuming from its checkpoint.
+
+    Returns:
+    --------
+        The checkpoint shard entries.
+    """
+    shards = plan_shards(config)
+    os.makedirs(config['output'], exist_ok=True)
+    checkpoint = Checkpoint(config['output'], fingerprint(config, shards), len(shards), restart)
+
+    matcher = LeuvenMatcher(config['city'] or 'matcher', graph=config['graph'], bgimg=config['bgimg'],
+                            extent=config['extent'], cache_dir=config['cache_dir'], profiles=config['profiles'])
+    matcher.init_matcher()
+    routes = config['mode'] == 'routes'
+
+    pending = deque()
+
+    def trajs():
+        for shard, (filename, start, end) in enumerate(shards):
+            entry = checkpoint.shards[shard]
+            if entry['done']:
+                continue
+            offset = start if entry['offset'] is None else entry['offset']
+            for batch, next_offset in read_trajs_range(filename, offset, end, chunk_size=config['chunk_size'],
+                                                       latlon=True, odd_points=not config['all_points']):
+                pending.append(_Pending(shard, next_offset, batch.driver_ids))
+                for i in range(len(batch)):
+                    yield batch[i]
+            pending.append(_Pending(shard, None, []))
+
+    sinks = {}
+
+    def sink_of(shard):
+        if shard not in sinks:
+            for other in list(sinks):
+                sinks.pop(other).close()
+            checkpoint.remove_parts(shard, checkpoint.shards[shard]['parts'])
+            # flushed explicitly at every commit
+            sinks[shard] = TripSink(config['output'], fmt='parquet', road_info=matcher.edge_info,
+                                    row_group_size=float('inf'), flush_interval=float('inf'), prefix=shard_prefix(shard))
+        return sinks[shard]
+
+    def commit_ready():
+        while pending and pending[0].n_done == len(pending[0].driver_ids):
+            chunk = pending.popleft()
+            sink = sink_of(chunk.shard)
+            sink.flush()
+            if chunk.offset is None:
+                checkpoint.commit(chunk.shard, checkpoint.shards[chunk.shard]['offset'], sink.seq, 0, 0, done=True)
+            else:
+                checkpoint.commit(chunk.shard, chunk.offset, sink.seq, len(chunk.driver_ids), chunk.n_matched)
+
+    try:
+        for res in matcher.match_many(trajs(), workers=config['workers'], chunksize=config['chunksize'],
+                                      segment_projected=True, preprocess=config['preprocess'],
+                                      windowed=config['windowed'], compact=not routes, route=routes):
+            commit_ready()
+            chunk = pending[0]
+            if res.result is not None:
+                entry = checkpoint.shards[chunk.shard]
+                trip_id = (chunk.shard << 32) | (entry['trajs'] + chunk.n_done)
+                trip = res.result
+                if routes:
+                    trip = trip.reset_index().rename(columns={'index': 'seq_i'})
+                    trip['trip'] = trip_id
+                sink_of(chunk.shard).add(trip, trip_info(trip_id, res.result, chunk.driver_ids[chunk.n_done],
+                                                         config['mode']))
+                chunk.n_matched += 1
+            chunk.n_done += 1
+        commit_ready()
+    finally:
+        # parts flushed past the last commit are removed on resume
+        for sink in sinks.values():
+            sink.close()
+    return checkpoint.shards
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=None, help="JSON file with any of the options")
+    parser.add_argument('--city', default=None, help=f"preset of graph, bgimg and extent: {', '.join(sorted(CITIES))}")
+    parser.add_argument('--graph', default=None, help="pickled graph")
+    parser.add_argument('--bgimg', default=None)
+    parser.add_argument('--extent', type=float, nargs=4, default=None)
+    parser.add_argument('--data-dir', dest='data_dir', default=None, help="directory prefix of the input files")
+    parser.add_argument('--input', nargs='+', default=None, help="trajectory csv files")
+    parser.add_argument('--output', default=None, help="parquet dataset directory, holds the checkpoint")
+    parser.add_argument('--workers', type=int, default=None, help="matching processes, os.cpu_count() by default")
+    parser.add_argument('--chunksize', type=int, default=None, help="trajectories sent to a worker at a time")
+    parser.add_argument('--shard-size', dest='shard_size', type=int, default=None, help="bytes of input per shard")
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help="bytes parsed and committed at a time")
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None, help="compiled map cache")
+    parser.add_argument('--mode', choices=['rows', 'routes'], default=None,
+                        help="one row per matched point or per edge traversal")
+    parser.add_argument('--preprocess', action='store_true', default=None)
+    parser.add_argument('--windowed', action='store_true', default=None)
+    parser.add_argument('--all-points', dest='all_points', action='store_true', default=None,
+                        help="keep every point instead of every other one")
+    parser.add_argument('--restart', action='store_true', help="discard the checkpoint and the written parts")
+    args = parser.parse_args(argv)
+
+    config = load_config(args)
+    shards = run(config, restart=args.restart)
+    print(f"{sum(s['matched'] for s in shards)}/{sum(s['trajs'] for s in shards)} trajectories matched, "
+          f"{sum(s['done'] for s in shards)}/{len(shards)} shards done")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+""" Local HTTP map matching service, see `matcher.service.MatchService`
+
+Usage:
+    python serve.py --city chengdu --port 8080 --workers 4
+    curl -X POST localhost:8080/match -d '{"traj": [[30.65341, 104.05558, 1541374547], ...]}'
+    curl localhost:8080/metrics
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import warnings
+
+from matcher.leuven_mapmatcher import LeuvenMatcher
+from matcher.metrics import MatchMetrics
+from matcher.service import MatchService
+from run_matching import CITIES
+
+warnings.filterwarnings('ignore')
+logging.getLogger("be.kuleuven.cs.dtai.mapmatching").setLevel(logging.ERROR)
+
+
+async def serve(args):
+    city = CITIES[args.city]
+    matcher = LeuvenMatcher(args.city, graph=args.graph or city['graph'], bgimg=city['bgimg'], extent=city['extent'],
+                            cache_dir=args.cache_dir, profiles=city.get('profiles'))
+    matcher.init_matcher()
+    matcher.instrument(MatchMetrics())
+    match_kwargs = {'preprocess': args.preprocess}
+    if args.mode == 'routes':
+        match_kwargs['route'] = True
+    async with MatchService(matcher, workers=args.workers, max_batch=args.max_batch,
+                            max_batch_points=args.max_batch_points, max_delay=args.max_delay,
+                            queue_size=args.queue_size, timeout=args.timeout, **match_kwargs) as service:
+        server = await service.serve(args.host, args.port)
+        print(f"matching {args.city} on http://{args.host}:{args.port} with {service.workers} workers", flush=True)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        async with server:
+            await stop.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--city', choices=sorted(CITIES), default='chengdu')
+    parser.add_argument('--graph', default=None, help="pickled graph, the city preset by default")
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None, help="compiled map cache")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None, help="matching processes, os.cpu_count() by default")
+    parser.add_argument('--max-batch', dest='max_batch', type=int, default=8)
+    parser.add_argument('--max-batch-points', dest='max_batch_points', type=int, default=2000)
+    parser.add_argument('--max-delay', dest='max_delay', type=float, default=0.002, help="seconds to fill a batch")
+    parser.add_argument('--queue-size', dest='queue_size', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds per request")
+    parser.add_argument('--mode', choices=['rows', 'routes'], default='rows')
+    parser.add_argument('--preprocess', action='store_true')
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
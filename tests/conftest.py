@@ -0,0 +1,32 @@
+import logging
+import os
+import sys
+import warnings
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from matcher.leuven_mapmatcher import LeuvenMatcher  # noqa: E402
+from trajectory import read_trajs  # noqa: E402
+
+warnings.filterwarnings('ignore')
+logging.getLogger("be.kuleuven.cs.dtai.mapmatching").setLevel(logging.ERROR)
+
+XIAN_EXTENT = [108.9219, 109.0100, 34.2049, 34.2786]
+
+
+def sample_trajs(limit=None):
+    """ The bundled Xi'an trips as (lat, lon, t) arrays. """
+    data_dir = os.path.join(ROOT, 'data')
+    trajs = [traj.copy() for batch in read_trajs(['small_xian.csv'], data_dir, latlon=True, odd_points=True)
+             for traj, _ in batch]
+    return trajs[:limit]
+
+
+@pytest.fixture(scope='session')
+def xian_matcher():
+    matcher = LeuvenMatcher('xian', graph=os.path.join(ROOT, 'data', 'xian_graph.pkl'), extent=XIAN_EXTENT)
+    matcher.init_matcher()
+    return matcher
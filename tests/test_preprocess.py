@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from preprocess import preprocess
+from conftest import sample_trajs
+
+
+def test_untimed_trajectory_needs_no_timestamps(xian_matcher):
+    traj = sample_trajs(1)[0][:, :2]
+
+    routes = xian_matcher.match_traj(traj, preprocess=True)
+
+    assert len(routes) > 0
+    assert all(len(part) > 0 and len(part[0]) == 3 for part in routes)
+
+
+def test_parts_are_matched_separately(xian_matcher):
+    first, second = sample_trajs(2)
+    outside = np.array([[0.0, 0.0, first[-1, 2] + 1.0]])
+    second = second.copy()
+    second[:, 2] += first[-1, 2] + 2.0 - second[0, 2]
+    traj = np.concatenate([first, outside, second])
+
+    routes = xian_matcher.match_traj(traj, preprocess=True)
+
+    assert len(routes) == 2
+    assert routes[0] == xian_matcher.match_traj(first, preprocess=True)[0]
+
+
+def test_time_steps_need_timestamps():
+    traj = np.array([[34.25, 108.95], [34.26, 108.96]])
+    with pytest.raises(ValueError):
+        preprocess(traj, max_speed=50)
+    assert [list(index) for index in preprocess(traj, min_dist=10)] == [[0, 1]]
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from matcher.leuven_mapmatcher import LeuvenMatcher
+from matcher.routing import TransitionCache
+from conftest import ROOT, XIAN_EXTENT, sample_trajs
+
+RADIUS = 200.0
+
+
+@pytest.fixture(scope='module')
+def pinned_matcher():
+    matcher = LeuvenMatcher('xian', graph=f'{ROOT}/data/xian_graph.pkl', extent=XIAN_EXTENT)
+    matcher.transition_params = dict(matcher.transition_params, precompute_radius=RADIUS)
+    matcher.init_matcher()
+    return matcher
+
+
+def test_pinned_routes_equal_computed(xian_matcher):
+    labels = xian_matcher.node_info['osm_id'].tolist()
+    pinned = TransitionCache(xian_matcher.map_arrays, labels)
+    pinned.precompute(RADIUS)
+    computed = TransitionCache(xian_matcher.map_arrays, labels)
+
+    assert len(pinned.table) > 0
+    assert all(key[:2] != key[2:] for key in pinned.table)
+    keys = list(pinned.table)
+    for key in keys[::max(len(keys) // 500, 1)]:
+        assert pinned.table[key] == pytest.approx(computed._compute(*key))
+    l1, l2 = next(iter(pinned.edge_lengths))
+    assert pinned.get(l1, l2, l1, l2) == computed.get(l1, l2, l1, l2) == 0.0
+
+
+def test_precompute_keeps_results(xian_matcher, pinned_matcher):
+    assert xian_matcher.transition_params['precompute_radius'] is None
+    for traj in sample_trajs(10):
+        expected = xian_matcher.match_traj(traj, segment_projected=True, compact=True)
+        result = pinned_matcher.match_traj(traj, segment_projected=True, compact=True)
+        assert (expected is None) == (result is None)
+        if expected is not None:
+            np.testing.assert_array_equal(result.road, expected.road)
+            np.testing.assert_array_equal(result.obs, expected.obs)
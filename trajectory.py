@@ -0,0 +1,173 @@
+import os
+import mmap
+
+import numpy as np
+
+
+class TrajBatch:
+    __slots__ = ['points', 'offsets', 'user_ids', 'driver_ids']
+
+    def __init__(self, points, offsets, user_ids, driver_ids):
+        """ Ragged batch of trajectories
+
+        All points of the batch live in one contiguous buffer, trajectory i is
+        `points[offsets[i]:offsets[i + 1]]`, a view without copy.
+
+        Args:
+        --------
+            points: float64 array (n_points, 3), [lon, lat, t] or [lat, lon, t] rows
+            offsets: int64 array (n_trajs + 1,)
+            user_ids: list of str
+            driver_ids: list of str
+        """
+        self.points = points
+        self.offsets = offsets
+        self.user_ids = user_ids
+        self.driver_ids = driver_ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i], self.driver_ids[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+def _odd_points(points, offsets):
+    """ Keep the points at odd positions of every trajectory plus its last point. """
+    counts = np.diff(offsets)
+    n_keep = counts // 2 + 1
+    new_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(n_keep, out=new_offsets[1:])
+    j = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1], n_keep)
+    local = np.where(j == np.repeat(counts // 2, n_keep), np.repeat(counts - 1, n_keep), 2 * j + 1)
+    return points[np.repeat(offsets[:-1], n_keep) + local], new_offsets
+
+
+def _parse_lines(lines, latlon, odd_points):
+    """ Parse DiDi-style lines: `user_id,driver_id,"[lon lat t, lon lat t, ...]"`. """
+    user_ids, driver_ids, payloads = [], [], []
+    counts = np.empty(len(lines), dtype=np.int64)
+    for i, line in enumerate(lines):
+        start = line.index(b'"[')
+        end = line.rindex(b']')
+        user_id, driver_id = line[:start - 1].split(b',')[:2]
+        user_ids.append(user_id.decode())
+        driver_ids.append(driver_id.decode())
+        payload = line[start + 2:end]
+        counts[i] = payload.count(b',') + 1
+        payloads.append(payload)
+
+    values = np.fromstring(b' '.join(payloads).replace(b',', b' '), sep=' ')
+    if len(values) != 3 * counts.sum():
+        raise ValueError("Malformed trajectory line: every point must have 3 values (lon lat t).")
+    points = values.reshape(-1, 3)
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if odd_points:
+        points, offsets = _odd_points(points, offsets)
+    if latlon:
+        points = points[:, [1, 0, 2]]
+    return TrajBatch(points, offsets, user_ids, driver_ids)
+
+
+def _chunks(fp, chunk_size, use_mmap):
+    """ Yield byte blocks that end on a line boundary. """
+    if use_mmap:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos, size = 0, len(buf)
+            while pos < size:
+                end = buf.find(b'\n', min(pos + chunk_size, size) - 1)
+                end = size if end == -1 else end + 1
+                yield buf[pos:end]
+                pos = end
+    else:
+        rest = b''
+        while True:
+            block = fp.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            if cut == 0:
+                rest = block
+                continue
+            rest = block[cut:]
+            yield block[:cut]
+        if rest:
+            yield rest
+
+
+def read_trajs(filenames, data_dir='', chunk_size=16 << 20, latlon=False, use_mmap=True, odd_points=False):
+    """ Chunked, vectorized trajectory reader
+
+    Args:
+    --------
+        filenames: list of csv files
+        data_dir: directory prefix of the files
+        chunk_size: approximate bytes parsed at once
+        latlon: reorder points to [lat, lon, t], the order `LeuvenMatcher.match_traj` expects
+        use_mmap: memory map the input instead of reading it in blocks
+        odd_points: keep only the points at odd positions plus the last one (halves the sampling rate),
+            the sampling `utils.traj_iter` applies
+
+    Yields:
+    --------
+        TrajBatch per chunk
+    """
+    for file in filenames:
+        with open(os.path.join(data_dir, file), 'rb') as fp:
+            for block in _chunks(fp, chunk_size, use_mmap):
+                lines = [line for line in block.splitlines() if line.strip()]
+                if lines:
+                    yield _parse_lines(lines, latlon, odd_points)
+
+
+def shard_ranges(size, shard_size):
+    """ Split a file of size bytes into [start, end) byte ranges of at most shard_size bytes. """
+    return [(start, min(start + shard_size, size)) for start in range(0, size, shard_size)] or [(0, 0)]
+
+
+def read_trajs_range(filename, start=0, end=None, chunk_size=16 << 20, latlon=False, odd_points=False):
+    """ Read the trajectories whose line starts in the byte range [start, end) of a file
+
+    Consecutive ranges cover every line exactly once, so a file can be sharded by byte ranges and
+    a shard resumed from any yielded offset.
+
+    Args:
+    --------
+        filename: csv file
+        start, end: byte range, end of file if end is None
+        chunk_size, latlon, odd_points: see `read_trajs`
+
+    Yields:
+    --------
+        (TrajBatch, offset) per chunk, offset is the byte right after the chunk, the start to resume from
+    """
+    with open(filename, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            # a line belongs to the range its first byte is in
+            pos = start if start == 0 or buf[start - 1:start] == b'\n' else buf.find(b'\n', start) + 1
+            if pos == 0 and start > 0:
+                return
+            while pos < end:
+                stop = buf.find(b'\n', min(pos + chunk_size, end) - 1)
+                stop = size if stop == -1 else stop + 1
+                lines = [line for line in buf[pos:stop].splitlines() if line.strip()]
+                batch = _parse_lines(lines, latlon, odd_points) if lines else \
+                    TrajBatch(np.empty((0, 3)), np.zeros(1, dtype=np.int64), [], [])
+                yield batch, stop
+                pos = stop
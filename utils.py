@@ -2,6 +2,8 @@ import math
 
 import numpy as np
 
+from trajectory import read_trajs
+
 pi = 3.1415926535897932384626
 a = 6378245.0
 ee = 0.00669342162296594323
@@ -52,6 +54,67 @@ def gcj2wgs(lat, lon):
     return lat * 2 - mgLat, lon * 2 - mgLon
 
 
+def transform_lat_array(x, y):
+    ret = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * np.sqrt(np.abs(x))
+    ret += (20.0 * np.sin(6.0 * x * pi) + 20.0 * np.sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(y * pi) + 40.0 * np.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    ret += (160.0 * np.sin(y / 12.0 * pi) + 320 * np.sin(y * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def transform_lon_array(x, y):
+    ret = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * np.sqrt(np.abs(x))
+    ret += (20.0 * np.sin(6.0 * x * pi) + 20.0 * np.sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(x * pi) + 40.0 * np.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    ret += (150.0 * np.sin(x / 12.0 * pi) + 300.0 * np.sin(x / 30.0 * pi)) * 2.0 / 3.0
+    return ret
+
+
+def _gcj_offset_array(lat, lon):
+    dLat = transform_lat_array(lon - 105.0, lat - 35.0)
+    dLon = transform_lon_array(lon - 105.0, lat - 35.0)
+    radLat = lat / 180.0 * pi
+    magic = np.sin(radLat)
+    magic = 1 - ee * magic * magic
+    sqrtMagic = np.sqrt(magic)
+    dLat = (dLat * 180.0) / ((a * (1 - ee)) / (magic * sqrtMagic) * pi)
+    dLon = (dLon * 180.0) / (a / sqrtMagic * np.cos(radLat) * pi)
+    return dLat, dLon
+
+
+def wgs2gcj_array(lat, lon):
+    """
+    Array version of wgs2gcj, lat/lon are array-likes (e.g. DataFrame columns) of the same length
+    """
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    dLat, dLon = _gcj_offset_array(lat, lon)
+    return lat + dLat, lon + dLon
+
+
+def gcj2wgs_array(lat, lon):
+    """
+    Array version of gcj2wgs, a one-step inverse with an error of a few meters
+    """
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    dLat, dLon = _gcj_offset_array(lat, lon)
+    return lat - dLat, lon - dLon
+
+
+def gcj2wgs_exact(lat, lon, tol=1e-9, max_iter=10):
+    """
+    Iterative inverse of wgs2gcj: refine the wgs guess until wgs2gcj(guess) is within tol degrees of the input
+    """
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    wgs_lat, wgs_lon = gcj2wgs_array(lat, lon)
+    for _ in range(max_iter):
+        gcj_lat, gcj_lon = wgs2gcj_array(wgs_lat, wgs_lon)
+        err_lat, err_lon = gcj_lat - lat, gcj_lon - lon
+        wgs_lat, wgs_lon = wgs_lat - err_lat, wgs_lon - err_lon
+        if max(np.max(np.abs(err_lat), initial=0), np.max(np.abs(err_lon), initial=0)) < tol:
+            break
+    return wgs_lat, wgs_lon
+
+
 def haversine(lon1, lat1, lon2, lat2):  # 经度1，纬度1，经度2，纬度2 （十进制度数）
     """
     Calculate the great circle distance between two points
@@ -87,26 +150,11 @@ def cal_angle(lat1, lon1, lat2, lon2):
     return float((brng + 360.0) % 360.0)
 
 
-def traj_iter(data_dir='../data/', filenames=['small_chengdu.csv']):
+def traj_iter(data_dir='../data/', filenames=['small_chengdu.csv'], latlon=False):
     """
-    Trajectory data iterator
+    Trajectory data iterator, yields (path, driver_id) where path is a (n, 3) array view
+    of [lon, lat, t] rows, or [lat, lon, t] rows if latlon. Only the odd points and the last one
+    of every trip are kept. See trajectory.read_trajs.
     """
-    traj_path = data_dir
-    for i, file in enumerate(filenames):
-        with open(traj_path + file) as fp:
-            line = fp.readline()
-            while line:
-                cols = line.split(',')
-                user_id = cols[0]
-                driver_id = cols[1]
-                traj = cols[2:]
-                traj[0] = traj[0][2:]
-                traj[-1] = traj[-1][:-3]
-                traj = traj[1::2] + traj[-1:]
-
-                traj_array = np.array([list(p.strip().split(' ')) for p in traj]).astype(float)
-                # timestamps = [traj_array[j, -1] for j in range(traj_array.shape[0])]
-                # path = [tuple(traj_array[j, :2]) for j in range(traj_array.shape[0])]
-                path = [tuple(traj_array[j, :]) for j in range(traj_array.shape[0])]
-                line = fp.readline()
-                yield path, driver_id
+    for batch in read_trajs(filenames, data_dir, latlon=latlon, odd_points=True):
+        yield from batch